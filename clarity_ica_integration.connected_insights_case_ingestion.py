@@ -1,19 +1,37 @@
 # Helper modules to interact with ICA Base
 import snowflake.connector
 from pprint import pprint
-import requests
 from requests.structures import CaseInsensitiveDict
 import pandas as pd
 import re
 import os
+import sys
 import argparse
 import json
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+from datetime import timedelta
+import connected_insights_case_metadata_upload as ci_upload
+import run_journal
+import rate_limiter
+import metadata_table
+import validation_report
+
+### ICA, Snowstorm and Connected Insights calls share one rate-limited session
+http_session = ci_upload.http_session
+
+### ICA region to talk to; per-call override so projects in several regions can be queried concurrently
+def get_ica_root_url(ica_root_url=None):
+    if ica_root_url is None:
+        ica_root_url = os.environ['ICA_ROOT_URL']
+    return ica_root_url
 
 ### check if API KEY is valid 
-def validate_api_key(api_key):
+def validate_api_key(api_key,ica_root_url=None):
     valid_api_key = False
-    api_base_url = os.environ['ICA_ROOT_URL'] +"/ica/rest"
+    api_base_url = get_ica_root_url(ica_root_url) + "/ica/rest"
     endpoint = f"/api/tokens"
     full_url = api_base_url + endpoint
     headers = CaseInsensitiveDict()
@@ -21,7 +39,7 @@ def validate_api_key(api_key):
     headers['Content-Type'] = 'application/vnd.illumina.v3+json'
     headers['X-API-Key'] = api_key
     try:
-        token_response = requests.get(full_url, headers=headers)
+        token_response = http_session.get(full_url, headers=headers)
         valid_api_key = True
     except:
         pprint(token_response,indent=4)
@@ -29,9 +47,9 @@ def validate_api_key(api_key):
     return(valid_api_key)
 
 ### check if PROJECT_ID is valid, do we allow by PROJECT_NAME as well?
-def valid_project_id(api_key,project_id):
+def valid_project_id(api_key,project_id,ica_root_url=None):
     valid_project_id = False
-    api_base_url = os.environ['ICA_ROOT_URL'] + "/ica/rest"
+    api_base_url = get_ica_root_url(ica_root_url) + "/ica/rest"
     endpoint = f"/api/projects/{project_id}"
     full_url = api_base_url + endpoint
     headers = CaseInsensitiveDict()
@@ -39,7 +57,7 @@ def valid_project_id(api_key,project_id):
     headers['Content-Type'] = 'application/vnd.illumina.v3+json'
     headers['X-API-Key'] = api_key
     try:
-        project_response = requests.get(full_url, headers=headers)
+        project_response = http_session.get(full_url, headers=headers)
         valid_project_id = True
     except:
         pprint(project_response,indent=4)
@@ -47,13 +65,13 @@ def valid_project_id(api_key,project_id):
     return(valid_project_id)
 
 ### use if project name is provided and project id is not
-def get_project_id(api_key, project_name):
+def get_project_id(api_key, project_name,ica_root_url=None):
     projects = []
     pageOffset = 0
     pageSize = 30
     page_number = 0
     number_of_rows_to_skip = 0
-    api_base_url = os.environ['ICA_ROOT_URL'] + "/ica/rest"
+    api_base_url = get_ica_root_url(ica_root_url) + "/ica/rest"
     endpoint = f"/api/projects?search={project_name}&includeHiddenProjects=true&pageOffset={pageOffset}&pageSize={pageSize}"
     full_url = api_base_url + endpoint  ############ create header
     headers = CaseInsensitiveDict()
@@ -61,10 +79,10 @@ def get_project_id(api_key, project_name):
     headers['Content-Type'] = 'application/vnd.illumina.v3+json'
     headers['X-API-Key'] = api_key
     try:
-        projectPagedList = requests.get(full_url, headers=headers)
+        projectPagedList = http_session.get(full_url, headers=headers)
         totalRecords = projectPagedList.json()['totalItemCount']
         while page_number * pageSize < totalRecords:
-            projectPagedList = requests.get(full_url, headers=headers)
+            projectPagedList = http_session.get(full_url, headers=headers)
             for project in projectPagedList.json()['items']:
                 projects.append({"name": project['name'], "id": project['id']})
             page_number += 1
@@ -78,8 +96,8 @@ def get_project_id(api_key, project_name):
         return projects[0]['id']
 ############
 
-def get_ica_base_connection(api_key,project_id):
-    api_base_url = os.environ['ICA_ROOT_URL'] + "/ica/rest"
+def get_ica_base_connection(api_key,project_id,ica_root_url=None):
+    api_base_url = get_ica_root_url(ica_root_url) + "/ica/rest"
     endpoint = f"/api/projects/{project_id}/base:connectionDetails"
     #### BOILERPLATE header JSON for most GET and POST requests via the API
     headers = CaseInsensitiveDict()
@@ -90,17 +108,17 @@ def get_ica_base_connection(api_key,project_id):
     full_url = api_base_url + endpoint
     ####### POST request to get ICA Base connection metadata
     try:
-        ICA_base_connection_details = requests.post(full_url, headers=headers)
+        ICA_base_connection_details = http_session.post(full_url, headers=headers)
         ICA_base_connection_details = ICA_base_connection_details.json()
     except:
         pprint(ICA_base_connection_details,indent = 4)
-        raise ValueError(f"Do you have ICA Base enabled in your project?\n\nDo you have any Base Tables in your project?\n\nCould not get ICA Base connection details for project: {project_name}")
+        raise ValueError(f"Do you have ICA Base enabled in your project?\n\nDo you have any Base Tables in your project?\n\nCould not get ICA Base connection details for project: {project_id}")
     return(ICA_base_connection_details)
 ###
 
 ### List Base tables see if any have Clarity in them?
-def get_base_tables(api_key,project_id):
-    api_base_url = os.environ['ICA_ROOT_URL'] + "/ica/rest"
+def get_base_tables(api_key,project_id,ica_root_url=None):
+    api_base_url = get_ica_root_url(ica_root_url) + "/ica/rest"
     endpoint = f"/api/projects/{project_id}/base/tables"
     full_url = api_base_url + endpoint
     #### BOILERPLATE header JSON for most GET and POST requests via the API
@@ -109,13 +127,13 @@ def get_base_tables(api_key,project_id):
     headers['Content-Type'] = 'application/vnd.illumina.v3+json'
     headers['X-API-Key'] = api_key
     try:
-        tables_response = requests.get(full_url, headers=headers)
+        tables_response = http_session.get(full_url, headers=headers)
     except:
         pprint(tables_response,indent=4)
         raise ValueError(f"Could not get ICA Base tables for the project {project_id}")
     return(tables_response.json()['items'])
 
-def base_table_sanity_check(ica_base_table_metadata):
+def base_table_sanity_check(ica_base_table_metadata,project_id=None):
     sanity_check_passed = True
     base_table_names = []
     for idx,t in enumerate(ica_base_table_metadata):
@@ -154,17 +172,36 @@ def connect_to_snowflake(ICA_base_connection_details):
 #snowflake_connector_object.cursor().execute(f"USE {ICA_base_connection_details['databaseName']}")
 
 
+### STEP 1 + STEP 2 in one go, so callers (e.g. watch mode) can re-open an expired connection
+def open_clarity_connection(api_key,project_id,ica_root_url=None,ica_base_table_metadata=None):
+    if ica_base_table_metadata is None:
+        ica_base_table_metadata = get_base_tables(api_key,project_id,ica_root_url)
+    if base_table_sanity_check(ica_base_table_metadata,project_id) is True:
+        ICA_base_connection_details = get_ica_base_connection(api_key,project_id,ica_root_url)
+    else:
+        raise ValueError(f"Does your project {project_id} have Base tables from the Data Catalogue in them?")
+    snowflake_connector_object = connect_to_snowflake(ICA_base_connection_details)
+    snowflake_connector_object.cursor().execute(f"USE {ICA_base_connection_details['databaseName']}")
+    return snowflake_connector_object
+
 ############# Default CLARITY table we are interested in from ICA Base
 #base_table_of_interest = "CLARITY_SAMPLE_VIEW_tenant"
-### TODO :: add potential filter by CREATE_TIME to limit number of records returned as number of samples grows?
+### created_after limits the records returned to those newer than a CREATE_TIME watermark
+### (inclusive=True also returns rows created exactly at the watermark)
 ### Specify query on fields that are of interest? For Troubleshooting (Connected Insights,Clarity, ICA)?
-def load_clarity_sample_table(snowflake_connector_object = None,  base_table_of_interest = None):
+def load_clarity_sample_table(snowflake_connector_object = None,  base_table_of_interest = None, created_after = None, inclusive = False):
     if snowflake_connector_object is None:
         raise ValueError(f"Please provide a snowflake connection object\nUse the functions get_ica_base_connection and connect_to_snowflake")
     df = None
     if base_table_of_interest is None:
         base_table_of_interest = "CLARITY_SAMPLE_VIEW_tenant"
-    base_query = f"SELECT * FROM {base_table_of_interest} ORDER BY CREATE_TIME"
+    query_params = None
+    if created_after is None:
+        base_query = f"SELECT * FROM {base_table_of_interest} ORDER BY CREATE_TIME"
+    else:
+        comparison = ">=" if inclusive is True else ">"
+        base_query = f"SELECT * FROM {base_table_of_interest} WHERE CREATE_TIME {comparison} %s ORDER BY CREATE_TIME"
+        query_params = (created_after,)
     # , ORDER BY CREATE_TIME DESC 
     print("SQL Query \n\n")
     pprint(base_query)
@@ -172,7 +209,7 @@ def load_clarity_sample_table(snowflake_connector_object = None,  base_table_of_
     cur = snowflake_connector_object.cursor()
     #### try finally block can probably be removed/simplified
     try:
-        cur.execute_async(base_query)
+        cur.execute_async(base_query, query_params)
         query_id = cur.sfqid
         cur.get_results_from_sfqid(query_id)
         base_results = cur.fetch_pandas_all()
@@ -183,6 +220,54 @@ def load_clarity_sample_table(snowflake_connector_object = None,  base_table_of_
 
 #print(df.head())
 
+### other CLARITY_* Base tables (e.g. sample views of additional tenants) that match a pattern
+def get_clarity_table_names(ica_base_table_metadata,base_table_pattern):
+    table_names = []
+    for t in ica_base_table_metadata:
+        if re.match("CLARITY",t['name']) is not None and re.match(base_table_pattern,t['name']) is not None:
+            table_names.append(t['name'])
+    return table_names
+
+### pre-flight, connect and query every table of one ICA project; rows are tagged with their source
+def load_clarity_source(source,base_tables=["Clarity_SAMPLE_VIEW_tenant"],base_table_pattern=None):
+    api_key = source['api_key']
+    ica_root_url = source['ica_root_url']
+    project_id = source['project_id']
+    if project_id is None:
+        project_id = get_project_id(api_key, source['project_name'], ica_root_url)
+    if valid_project_id(api_key,project_id,ica_root_url) is True:
+        print(f"[Pre-Flight-Check] ICA Project {project_id} is valid and accessible to user")
+    ica_base_table_metadata = get_base_tables(api_key,project_id,ica_root_url)
+    tables_of_interest = list(base_tables)
+    if base_table_pattern is not None:
+        ### Snowflake table names are case-insensitive
+        tables_seen = [t.upper() for t in tables_of_interest]
+        for table_name in get_clarity_table_names(ica_base_table_metadata,base_table_pattern):
+            if table_name.upper() not in tables_seen:
+                tables_of_interest.append(table_name)
+                tables_seen.append(table_name.upper())
+    snowflake_connector_object = open_clarity_connection(api_key,project_id,ica_root_url,ica_base_table_metadata)
+    clarity_sample_frames = []
+    try:
+        for table_name in tables_of_interest:
+            print(f"Loading data from Base table {table_name} in project {project_id}")
+            df = load_clarity_sample_table(snowflake_connector_object = snowflake_connector_object,  base_table_of_interest = table_name)
+            df["SOURCE_PROJECT"] = project_id
+            df["SOURCE_TABLE"] = table_name
+            clarity_sample_frames.append(df)
+    finally:
+        snowflake_connector_object.close()
+    return clarity_sample_frames
+
+### fan out over ICA projects with a bounded pool and merge the results in the order the projects were given
+def load_clarity_sources(sources,base_tables=["Clarity_SAMPLE_VIEW_tenant"],base_table_pattern=None,max_workers=4):
+    clarity_sample_frames = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(load_clarity_source,source,base_tables,base_table_pattern) for source in sources]
+        for future in futures:
+            clarity_sample_frames = clarity_sample_frames + future.result()
+    return pd.concat(clarity_sample_frames, ignore_index=True)
+
 ### check if nothing is returned --- valid sample id or is this the right table name?
 def subset_clarity_sample_view(clarity_sample_data = None, sample_ids = [], clarity_lims_sample_project = None):
     column_of_interest = "DATA"
@@ -199,26 +284,27 @@ def subset_clarity_sample_view(clarity_sample_data = None, sample_ids = [], clar
     ## parse this column, it will be a JSON
     ## Will convert JSON string into python object
     sample_metadata = [json.loads(d) for d in clarity_sample_data[column_of_interest]]
+    ## keep track of which project/table each record came from
+    if "SOURCE_PROJECT" in clarity_sample_data.columns:
+        for record,source_project,source_table in zip(sample_metadata,clarity_sample_data["SOURCE_PROJECT"],clarity_sample_data["SOURCE_TABLE"]):
+            record['sourceProject'] = source_project
+            record['sourceTable'] = source_table
+    first_source_by_sample = dict()
     for record in sample_metadata:
         if len(sample_ids) > 0 and clarity_lims_sample_project is None:
-            if record['id'] in sample_ids:
-                results.append(record)
-                if record['id'] in sample_id_count.keys():
-                    sample_id_count[record['id']] = sample_id_count[record['id']] + 1
+            is_match = record['id'] in sample_ids
         elif len(sample_ids) < 1 and clarity_lims_sample_project is not None:
-            if record['limsSampleProject'] == clarity_lims_sample_project:
-                results.append(record)
-                if record['id'] in sample_id_count.keys():
-                    sample_id_count[record['id']] = sample_id_count[record['id']] + 1
-                else:
-                    sample_id_count[record['id']] = 1
-        elif  len(sample_ids) > 0 and clarity_lims_sample_project is not None:
-            if record['limsSampleProject'] == clarity_lims_sample_project and record['id'] in sample_ids:
-                results.append(record)
-                if record['id'] in sample_id_count.keys():
-                    sample_id_count[record['id']] = sample_id_count[record['id']] + 1
-                else:
-                    sample_id_count[record['id']] = 1
+            is_match = record['limsSampleProject'] == clarity_lims_sample_project
+        else:
+            is_match = record['limsSampleProject'] == clarity_lims_sample_project and record['id'] in sample_ids
+        if is_match is False:
+            continue
+        results.append(record)
+        ### copies of the sample from other projects/tables are left to remove_cross_source_duplicates
+        source = (record.get('sourceProject'), record.get('sourceTable'))
+        if first_source_by_sample.setdefault(record['id'], source) != source:
+            continue
+        sample_id_count[record['id']] = sample_id_count.get(record['id'], 0) + 1
 
     # check for each sample if we've gotten any results, multiple results
     for sample_id in list(sample_id_count.keys()):
@@ -226,7 +312,7 @@ def subset_clarity_sample_view(clarity_sample_data = None, sample_ids = [], clar
         if number_of_results == 0:
             raise ValueError(f"Could not find any results for {sample_id}")
         if number_of_results > 1:
-            pprint(results,indent=4)
+            pprint([record for record in results if record['id'] == sample_id],indent=4)
             print(f"[WARNING] Found multiple results for {sample_id}")
     # or no results
     if len(results) < 1:
@@ -239,55 +325,163 @@ def subset_clarity_sample_view(clarity_sample_data = None, sample_ids = [], clar
         raise ValueError(f"{error_string}")
     return results
 
+### the same sample coming from more than one project/table: keep the first source given, warn about the rest
+def remove_cross_source_duplicates(sample_records):
+    results = []
+    sources_by_sample = dict()
+    for record in sample_records:
+        source = (record.get('sourceProject'), record.get('sourceTable'))
+        if record['id'] not in sources_by_sample.keys():
+            sources_by_sample[record['id']] = [source]
+        elif source not in sources_by_sample[record['id']]:
+            sources_by_sample[record['id']].append(source)
+        if sources_by_sample[record['id']][0] == source:
+            results.append(record)
+    for sample_id in sources_by_sample:
+        if len(sources_by_sample[sample_id]) > 1:
+            sources_str = ", ".join([f"{p}/{t}" for p,t in sources_by_sample[sample_id]])
+            kept_project,kept_table = sources_by_sample[sample_id][0]
+            print(f"[Warning] Sample {sample_id} found in multiple sources: {sources_str}. Keeping {kept_project}/{kept_table}")
+    return results
+
+def write_provenance_csv(provenance_csv,sample_records):
+    rows = ([str(record['id']),str(record.get('sourceProject', "")),str(record.get('sourceTable', ""))] for record in sample_records)
+    return metadata_table.write_metadata_csv(provenance_csv,["Sample_ID","Source_Project","Source_Table"],rows)
+
 ### check if sample has metadata fields we are looking for
 # in case Clarity stores info differently from the fields we are interested in
 field_map_dict = dict()
 field_map_dict["Sample_ID"] = "id" 
 mandatory_fields = ["Sample_ID", "Tumor_Type", "Case_ID","Sample_Type","Sex"]
 ### SAMPLE_TYPE (DNA/RNA) is likely a required field for TSO, [OPTIONAL] Test_Definition --- in case multiple versions might be used?
-### TODO: may need to query Connected Insights to grab custom fields associated to Test_Definition/workflow
-### these are optional for now --- cases ingested via this script
+### mandatory_fields/other_fields_of_interest apply to rows whose Test_Definition is unknown (or when no Connected Insights
+### workgroup is configured). Otherwise the required and custom fields of the row's Test_Definition are used, see RowExtractor
 ### custom fields can be mandatory for case ingestion
 ### 3.0 and 4.0 have different API routes
 other_fields_of_interest = ["Sample_Classification","Tags","Test_Definition","Sample Name(s)"]
+### fields every case needs, whatever its Test_Definition
+case_mandatory_fields = ["Sample_ID", "Tumor_Type", "Case_ID"]
 fields_ignore = ["container"]
-def parse_table_row(row):
-    row_mandatory_fields = dict()
-    row_optional_fields = dict()
-    for idx,field in enumerate(row):
-        if field not in fields_ignore:
-            if field == "userDefinedFields":
-                for i,x in enumerate(row["userDefinedFields"]):
-                    if x["key"] in mandatory_fields:
-                        for k in mandatory_fields:
-                            if x["key"] == k:
-                                row_mandatory_fields[k] = x["value"]
-                    elif x["key"] in other_fields_of_interest:
-                        for k in other_fields_of_interest:
-                            if x["key"] == k:
-                                row_optional_fields[k] = x["value"]
-                    elif x["key"] in list(field_map_dict.values()):
-                        for i,k in enumerate(field_map_dict):
-                            if x["key"] == field_map_dict[k] and k in mandatory_fields:
-                                row_mandatory_fields[k] = x["value"]
-                            elif x["key"] == field_map_dict[k] and k in other_fields_of_interest:
-                                row_optional_fields[k] = x["value"]
-            else:
-                if field in mandatory_fields:
-                    for k in mandatory_fields:
-                        if field == k:
-                            row_mandatory_fields[k] = row[field]
-                elif field in other_fields_of_interest:
-                    for k in other_fields_of_interest:
-                        if field == k:
-                            row_optional_fields[k] = row[field]
-                elif field in list(field_map_dict.values()):
-                    for i,k in enumerate(field_map_dict):
-                        if field == field_map_dict[k] and k in mandatory_fields:
-                            row_mandatory_fields[k] = row[field]
-                        elif field == field_map_dict[k] and k in other_fields_of_interest:
-                            row_optional_fields[k] = row[field]
-    return (row_mandatory_fields,row_optional_fields)
+
+### Row extractor compiled from the field lists: one dict maps every key a Clarity row may use (the field name, or its
+### Clarity name from field_map_dict) to the field it fills, so a row is parsed in a single pass of dict lookups.
+### The fields are then split into mandatory/optional following the Test_Definition of the row
+class RowExtractor:
+    def __init__(self,test_definitions=None):
+        self.test_definitions = test_definitions or dict()
+        self.default_schema = (tuple(mandatory_fields), tuple(other_fields_of_interest))
+        self.schemas = dict()
+        for test_definition,schema in self.test_definitions.items():
+            ### a Test_Definition read without any fields keeps the default validation instead of dropping fields
+            if len(schema['required_fields']) == 0 and len(schema['custom_fields']) == 0:
+                print(f"[Warning] No fields found for Test_Definition {test_definition}. Using the default mandatory and optional fields")
+                self.schemas[test_definition] = self.default_schema
+                continue
+            required = case_mandatory_fields + [field for field in schema['required_fields'] if field not in case_mandatory_fields]
+            optional = []
+            ### the default mandatory fields are always kept (as optional) so they stay in the CSV and are still validated
+            for field in mandatory_fields + other_fields_of_interest + schema['custom_fields']:
+                if field not in required and field not in optional:
+                    optional.append(field)
+            self.schemas[test_definition] = (tuple(required), tuple(optional))
+        all_fields = set(self.default_schema[0] + self.default_schema[1])
+        for required,optional in self.schemas.values():
+            all_fields.update(required + optional)
+        ### a field given under its own name wins over its Clarity name
+        self.lookup = dict()
+        for field,clarity_name in field_map_dict.items():
+            if field in all_fields:
+                self.lookup[clarity_name] = sys.intern(field)
+        for field in all_fields:
+            self.lookup[field] = sys.intern(field)
+        self.field_sets = {test_definition: (frozenset(required), frozenset(optional)) for test_definition,(required,optional) in self.schemas.items()}
+        self.default_field_sets = (frozenset(self.default_schema[0]), frozenset(self.default_schema[1]))
+
+    ### (required fields, optional fields) of a Test_Definition
+    def schema(self,test_definition):
+        return self.schemas.get(test_definition, self.default_schema)
+
+    ### rows without a Test_Definition use the default schema and are not reported
+    def is_configured(self,test_definition):
+        return test_definition is None or len(self.schemas) == 0 or test_definition in self.schemas.keys()
+
+    def extract(self,row):
+        lookup = self.lookup
+        values = dict()
+        for key,value in row.items():
+            if key == "userDefinedFields":
+                for x in value:
+                    field = lookup.get(x["key"])
+                    if field is not None:
+                        values[field] = x["value"]
+            elif key not in fields_ignore:
+                field = lookup.get(key)
+                if field is not None:
+                    values[field] = value
+        required,optional = self.field_sets.get(values.get("Test_Definition"), self.default_field_sets)
+        row_mandatory_fields = dict()
+        row_optional_fields = dict()
+        for field,value in values.items():
+            if field in required:
+                row_mandatory_fields[field] = value
+            elif field in optional:
+                row_optional_fields[field] = value
+        return (row_mandatory_fields,row_optional_fields)
+
+default_row_extractor = RowExtractor()
+
+def parse_table_row(row,row_extractor=None):
+    if row_extractor is None:
+        row_extractor = default_row_extractor
+    return row_extractor.extract(row)
+
+### Extractor for the Test_Definitions of the Connected Insights workgroup (cached in test_definition_cache).
+### The workgroup is either given as ci_context or resolved from the --ci_* options in args.
+### Falls back to the fields above when no workgroup is configured, or it cannot be reached or the Test_Definitions cannot be fetched
+def load_row_extractor(ci_context=None,test_definition_cache="test_definition_cache.json",ttl_hours=24,args=None):
+    if ci_context is None and args is None:
+        return default_row_extractor
+    try:
+        if ci_context is None:
+            ci_context = get_ci_context(args)
+        test_definitions = ci_upload.get_test_definitions_cached(ci_context['domain_url'],ci_context['auth_credentials'],test_definition_cache,ttl_hours)
+    except Exception as e:
+        print(f"[Warning] {e}. Using the default mandatory and optional fields")
+        return default_row_extractor
+    return RowExtractor(test_definitions)
+
+### Column-oriented store for parsed sample metadata: one list per field (None where a row has no value)
+### instead of a [mandatory dict, optional dict] pair per row. Field names are interned and the
+### fields found across all rows are kept as set unions, so a million rows cost one list slot per field
+class ParsedSampleRows:
+    __slots__ = ("columns", "row_count", "mandatory_fields_found", "optional_fields_found")
+
+    def __init__(self):
+        self.columns = dict()
+        self.row_count = 0
+        self.mandatory_fields_found = set()
+        self.optional_fields_found = set()
+
+    def append(self,row_mandatory_fields,row_optional_fields):
+        self.mandatory_fields_found |= row_mandatory_fields.keys()
+        self.optional_fields_found |= row_optional_fields.keys()
+        for row_fields in (row_mandatory_fields,row_optional_fields):
+            for field,value in row_fields.items():
+                if field not in self.columns:
+                    self.columns[sys.intern(field)] = [None] * self.row_count
+                self.columns[field].append(value)
+        self.row_count = self.row_count + 1
+        ### pad the columns this row has no value for
+        for column in self.columns.values():
+            if len(column) < self.row_count:
+                column.append(None)
+
+    def get(self,field,row_number):
+        column = self.columns.get(field)
+        if column is None:
+            return None
+        return column[row_number]
+
 
 def snomedct_id_validation(snowmedct_id):
     is_valid = False
@@ -305,7 +499,7 @@ def snomedct_id_validation(snowmedct_id):
     params['ecl'] = f"{snowmedct_id}"
     snowstorm_response = None
     try:
-        snowstorm_response = requests.get(snowstorm_full_url, headers=headers,params=params)
+        snowstorm_response = http_session.get(snowstorm_full_url, headers=headers,params=params)
         snowstorm_items = snowstorm_response.json()['items'][0]
         expected_fields = ['id','conceptId','active','fsn']
         expected_fields_count = 0
@@ -322,27 +516,379 @@ def snomedct_id_validation(snowmedct_id):
 field_validate_dict = dict()
 field_validate_dict['Sample_Type'] = ["DNA","RNA"]
 field_validate_dict['Sex'] = ["Male", "Female"] 
+### None when the field has no list of valid values
 def field_validator(field_of_interest,value_given):
     field_valid = False
-    if field_of_interest not in list(field_validate_dict.keys()):
+    if field_of_interest not in field_validate_dict.keys():
         field_valid = None
     else:
         if value_given in field_validate_dict[field_of_interest]:
-            field_valid = False
+            field_valid = True
     return field_valid
 ############################################
+### Watch mode: poll Clarity for new samples and upload complete cases in micro-batches
+shutdown_event = threading.Event()
+
+def request_shutdown(signum, frame):
+    print(f"[Watch] Received signal {signum}, shutting down after the current cycle")
+    shutdown_event.set()
+
+def load_watch_state(watch_state_file):
+    watch_state = {"watermark": None, "pending": {}, "uploaded": {}, "late_samples": {}}
+    if os.path.isfile(watch_state_file) is True:
+        with open(watch_state_file, 'r') as f:
+            watch_state.update(json.load(f))
+    return watch_state
+
+### write to a temp file first so a kill mid-write never leaves a truncated state file
+def save_watch_state(watch_state_file,watch_state):
+    tmp_file = f"{watch_state_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(watch_state, f, indent=4)
+    os.replace(tmp_file, watch_state_file)
+
+def is_complete_case(row_mandatory_fields,required_fields=mandatory_fields):
+    for mandatory in required_fields:
+        if mandatory not in row_mandatory_fields.keys():
+            return False
+        if row_mandatory_fields[mandatory] is None or str(row_mandatory_fields[mandatory]) == "":
+            return False
+    return True
+
+def write_case_metadata_csv(output_csv,parsed_rows):
+    mandatory_fields_found = list(mandatory_fields)
+    optional_fields_found = []
+    for r in parsed_rows:
+        for mandatory in r[0].keys():
+            if mandatory not in mandatory_fields_found:
+                mandatory_fields_found.append(mandatory)
+        for optional in r[1].keys():
+            if optional not in optional_fields_found:
+                optional_fields_found.append(optional)
+    optional_fields_found = [optional for optional in optional_fields_found if optional not in mandatory_fields_found]
+    all_headers = mandatory_fields_found + optional_fields_found
+    rows = ([str(r[0].get(k, r[1].get(k, ""))) for k in mandatory_fields_found] + [str(r[1].get(k, "")) for k in optional_fields_found] for r in parsed_rows)
+    return metadata_table.write_metadata_csv(output_csv,all_headers,rows)
+
+### Returns (CREATE_TIME, parsed row) pairs ready for upload grouped by Case_ID, and updates the pending set in watch_state
+### Pending samples are re-queried every cycle until they are complete or older than pending_max_age_hours
+def collect_watch_cases(clarity_sample_data,watch_state,lims_sample_projects,configured_snowmedct_ids,cases_present,pending_max_age_hours,row_extractor=None):
+    if row_extractor is None:
+        row_extractor = default_row_extractor
+    cases_ready = dict()
+    cases_blocked = set()
+    new_pending = dict()
+    watermark = watch_state['watermark']
+    pending_cutoff = (dt.now() - timedelta(hours=pending_max_age_hours)).isoformat()
+    for data,create_time in zip(clarity_sample_data["DATA"],clarity_sample_data["CREATE_TIME"]):
+        create_time = pd.Timestamp(create_time).isoformat()
+        if watermark is None or create_time > watermark:
+            watermark = create_time
+        record = json.loads(data)
+        if len(lims_sample_projects) > 0 and record.get('limsSampleProject') not in lims_sample_projects:
+            continue
+        parsed_objects = parse_table_row(record,row_extractor)
+        case_id = parsed_objects[0].get("Case_ID")
+        ### re-queried from the oldest pending sample: samples uploaded in an earlier batch come back and are skipped
+        if record['id'] in watch_state['uploaded'].keys():
+            continue
+        ### e.g. an RNA sample following the DNA sample of an already uploaded case: it is not added to the case, only recorded
+        if case_id is not None and case_id in cases_present:
+            if record['id'] not in watch_state['late_samples'].keys():
+                print(f"[Warning] Sample {record['id']} arrived after case {case_id} was ingested in Connected Insights. It is not uploaded and is recorded under late_samples in the watch state file")
+                watch_state['late_samples'][record['id']] = {"case_id": case_id, "create_time": create_time}
+            continue
+        reason = None
+        ### Test_Definition can be a required field of its own schema
+        test_definition = parsed_objects[1].get("Test_Definition", parsed_objects[0].get("Test_Definition"))
+        if is_complete_case(parsed_objects[0],row_extractor.schema(test_definition)[0]) is False:
+            reason = "missing mandatory fields"
+        elif row_extractor.is_configured(test_definition) is False:
+            reason = f"Test_Definition {test_definition} is not configured in Connected Insights"
+        elif str(parsed_objects[0]["Tumor_Type"]) not in configured_snowmedct_ids:
+            reason = f"Tumor_Type {parsed_objects[0]['Tumor_Type']} is not configured in Connected Insights"
+        if reason is not None:
+            if create_time < pending_cutoff:
+                print(f"[Warning] Dropping sample {record['id']} from watch mode after {pending_max_age_hours} hours: {reason}")
+            else:
+                new_pending[record['id']] = create_time
+            if case_id is not None:
+                cases_blocked.add(case_id)
+            continue
+        if case_id not in cases_ready.keys():
+            cases_ready[case_id] = []
+        cases_ready[case_id].append((create_time, list(parsed_objects)))
+    ### a case is only uploaded once every sample belonging to it is complete
+    for case_id in cases_blocked:
+        if case_id in cases_ready.keys():
+            for create_time,r in cases_ready.pop(case_id):
+                new_pending[r[0]["Sample_ID"]] = create_time
+    watch_state['watermark'] = watermark
+    watch_state['pending'] = new_pending
+    return cases_ready
+
+def upload_watch_batches(cases_ready,watch_state,ci_context,batch_size,output_dir):
+    case_ids = list(cases_ready.keys())
+    timestampStr = dt.now().strftime("%Y%b%d_%H_%M_%S_%f")
+    for batch_number,batch_start in enumerate(range(0, len(case_ids), batch_size)):
+        batch_case_ids = case_ids[batch_start:batch_start + batch_size]
+        parsed_rows = [r for case_id in batch_case_ids for create_time,r in cases_ready[case_id]]
+        batch_csv = os.path.join(output_dir, f"case_metadata.connected_insights.{timestampStr}.batch{batch_number}.csv")
+        write_case_metadata_csv(batch_csv,parsed_rows)
+        print(f"[Watch] Uploading {len(batch_case_ids)} case(s) in {batch_csv}")
+        ingestion_status = None
+        try:
+            file_id = ci_upload.upload_case_metadata(ci_context['domain_url'],ci_context['auth_credentials'],batch_csv)
+            ingestion_metadata = ci_upload.wait_for_ingestion(ci_context['domain_url'],ci_context['auth_credentials'],file_id,poll_interval=5)
+            ingestion_status = str(ingestion_metadata['status'])
+        except Exception as e:
+            print(f"[Warning] Could not upload {batch_csv}: {e}")
+        if ingestion_status is not None:
+            print(f"[Watch] Ingestion of {batch_csv} finished with status {ingestion_status}")
+        ### keep the samples pending so the next cycle retries them
+        if ingestion_status is None or "FAIL" in ingestion_status.upper() or "ERROR" in ingestion_status.upper():
+            for case_id in batch_case_ids:
+                for create_time,r in cases_ready[case_id]:
+                    watch_state['pending'][r[0]["Sample_ID"]] = create_time
+            continue
+        for case_id in batch_case_ids:
+            ci_context['cases_present'][case_id] = ingestion_status
+            for create_time,r in cases_ready[case_id]:
+                watch_state['uploaded'][r[0]["Sample_ID"]] = create_time
+
+### the next cycle re-queries from the oldest pending sample (inclusive) or after the watermark:
+### uploaded samples older than that cannot come back, so they are no longer tracked
+def prune_uploaded_samples(watch_state):
+    if len(watch_state['pending']) == 0:
+        watch_state['uploaded'] = dict()
+        return watch_state
+    oldest_pending = min(watch_state['pending'].values())
+    watch_state['uploaded'] = {sample_id: create_time for sample_id,create_time in watch_state['uploaded'].items() if create_time >= oldest_pending}
+    return watch_state
+
+def run_watch_mode(api_key,project_id,ci_context,ica_root_url=None,base_table_of_interest="Clarity_SAMPLE_VIEW_tenant",lims_sample_projects=[],watch_state_file="clarity_watch_state.json",poll_interval=300,batch_size=50,output_dir=".",pending_max_age_hours=24,test_definition_cache="test_definition_cache.json",test_definition_ttl_hours=24):
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    watch_state = load_watch_state(watch_state_file)
+    ### disease and case sets are fetched once and kept warm between cycles
+    configured_snowmedct_ids = list(ci_upload.get_diseases_configured(ci_context['domain_url'],ci_context['auth_credentials']).keys())
+    ci_context['cases_present'] = ci_upload.get_cases_present(ci_context['domain_url'],ci_context['auth_credentials'])
+    snowflake_connector_object = None
+    print(f"[Watch] Polling {base_table_of_interest} every {poll_interval} seconds. Watermark: {watch_state['watermark']}")
+    while shutdown_event.is_set() is False:
+        try:
+            if snowflake_connector_object is None:
+                snowflake_connector_object = open_clarity_connection(api_key,project_id,ica_root_url)
+            created_after = watch_state['watermark']
+            inclusive = False
+            ### pending samples are never newer than the watermark, so start from the oldest one
+            if len(watch_state['pending']) > 0:
+                created_after = min(watch_state['pending'].values())
+                inclusive = True
+            clarity_sample_data = load_clarity_sample_table(snowflake_connector_object = snowflake_connector_object, base_table_of_interest = base_table_of_interest, created_after = created_after, inclusive = inclusive)
+        except Exception as e:
+            ### ICA Base credentials expire; drop the connection and re-open it next cycle
+            print(f"[Warning] Could not query {base_table_of_interest}: {e}")
+            if snowflake_connector_object is not None:
+                snowflake_connector_object.close()
+            snowflake_connector_object = None
+            shutdown_event.wait(poll_interval)
+            continue
+        ### re-read every cycle: the Test_Definitions are only fetched again once the cached ones are older than the TTL
+        row_extractor = load_row_extractor(ci_context,test_definition_cache,test_definition_ttl_hours)
+        cases_ready = collect_watch_cases(clarity_sample_data,watch_state,lims_sample_projects,configured_snowmedct_ids,ci_context['cases_present'],pending_max_age_hours,row_extractor)
+        if len(cases_ready) > 0:
+            upload_watch_batches(cases_ready,watch_state,ci_context,batch_size,output_dir)
+        prune_uploaded_samples(watch_state)
+        save_watch_state(watch_state_file,watch_state)
+        print(f"[Watch] Cycle done: {len(cases_ready)} case(s) ready, {len(watch_state['pending'])} sample(s) pending. Watermark: {watch_state['watermark']}")
+        shutdown_event.wait(poll_interval)
+    if snowflake_connector_object is not None:
+        snowflake_connector_object.close()
+    save_watch_state(watch_state_file,watch_state)
+    http_session.report()
+    print(f"[Watch] Stopped. State saved to {watch_state_file}")
+############################################
+### STEP 4 - STEP 6: subset the Clarity data, check the fields of interest and write the metadata CSV
+### (plus Parquet/Arrow files for the other output_formats). Issues are collected in a validation report written once
+### (default: <output_csv>.validation.json). Returns the number of lines with missing fields and the files written
+def generate_case_metadata(clarity_sample_data,sample_ids,lims_sample_project,output_csv,write_provenance=False,output_formats=["csv"],validation_report_file=None,validation_sample_limit=20,row_extractor=None):
+    # STEP 4: Subset view by sample id(s) or by lims_sample_project
+    print(f"STEP 4: Subsetting Sample metadata by sample ID or Clarity LIMS project name")
+    if len(sample_ids) < 1 and lims_sample_project is not None:
+        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = [], clarity_lims_sample_project = lims_sample_project)
+    elif len(sample_ids) > 0 and lims_sample_project is None:
+        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = sample_ids, clarity_lims_sample_project = None)
+    elif len(sample_ids) > 0 and lims_sample_project is not None:
+        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = sample_ids, clarity_lims_sample_project = lims_sample_project)
+    subset_clarity_sample_data = remove_cross_source_duplicates(subset_clarity_sample_data)
+
+    # STEP 5: Sanity check we have all mandatory fields for ingestion ;  warning for missing (optional + custom) fields
+    print(f"STEP 5: Checking Sample data of interest to see if we have data of interest")
+    # First pass --- collect info
+    if row_extractor is None:
+        row_extractor = default_row_extractor
+    parsed_rows = ParsedSampleRows()
+    for r in subset_clarity_sample_data:
+        parsed_objects = parse_table_row(r,row_extractor)
+        parsed_rows.append(parsed_objects[0],parsed_objects[1])
+
+    # second pass form lines based on the mandatory fields of the Test_Definitions found and union of optional_fields --- if optional fields is empty, ignore
+    test_definitions_found = [None]
+    for row_number in range(parsed_rows.row_count):
+        test_definition = parsed_rows.get("Test_Definition",row_number)
+        if test_definition not in test_definitions_found:
+            test_definitions_found.append(test_definition)
+    mandatory_headers = []
+    optional_headers = []
+    for test_definition in test_definitions_found:
+        required,optional = row_extractor.schema(test_definition)
+        mandatory_headers = mandatory_headers + [field for field in required if field not in mandatory_headers]
+        optional_headers = optional_headers + [field for field in optional if field not in optional_headers]
+    mandatory_fields_found = parsed_rows.mandatory_fields_found
+    optional_fields_found = [optional for optional in optional_headers if optional in parsed_rows.optional_fields_found and optional not in mandatory_headers]
+    if len(mandatory_fields_found) == 0 and len(optional_fields_found) == 0:
+        raise ValueError(f"Could not find any fields on interest")
+    elif len(mandatory_fields_found) == 0:    
+        mandatory_fields_str = ", ".join(mandatory_headers)
+        raise ValueError(f"Could not find any of the mandatory fields on interest {mandatory_fields_str}")
+    
+    warning_lines = 0
+    all_headers = mandatory_headers + optional_fields_found
+    report = validation_report.ValidationReport(output_csv,sample_limit=validation_sample_limit)
+    for field_of_interest,valid_values in field_validate_dict.items():
+        report.set_expected_values(field_of_interest,valid_values)
+    if len(row_extractor.schemas) > 0:
+        report.set_expected_values("Test_Definition",row_extractor.schemas.keys())
+    ### the same Tumor_Type is usually shared by many rows: look each identifier up once
+    snomedct_id_checked = dict()
+    # STEP 6: Generate metadata CSV --- rows are streamed to the file(s) as they are checked
+    print(f"STEP 6: Creating metadata CSV for ingestion into Connected Insights")
+    metadata_writer = metadata_table.MetadataTableWriter(output_csv,all_headers,output_formats)
+    for row_number in range(parsed_rows.row_count):
+        final_line = []
+        issues = []
+        missing_fields = False
+        ### fields are checked against the Test_Definition of the row; columns only needed by other Test_Definitions are left empty
+        test_definition = parsed_rows.get("Test_Definition",row_number)
+        if row_extractor.is_configured(test_definition) is False:
+            issues.append(("Test_Definition","not_configured_in_workgroup",test_definition))
+        required,optional = row_extractor.schema(test_definition)
+        #### mandatory fields for row
+        for mandatory in mandatory_headers:
+            value = parsed_rows.get(mandatory,row_number)
+            if value is not None:
+                final_line.append(str(value))
+                if mandatory == "Tumor_Type":
+                    if value not in snomedct_id_checked.keys():
+                        snomedct_id_checked[value] = snomedct_id_validation(snowmedct_id=value)
+                    if snomedct_id_checked[value] is False:
+                        issues.append((mandatory,"invalid_snomedct_id",value))
+                field_valid = field_validator(mandatory,value)
+                if field_valid is False:
+                    issues.append((mandatory,"invalid_value",value))
+            else:
+                final_line.append("")
+                if mandatory in required:
+                    missing_fields = True
+                    issues.append((mandatory,"missing_mandatory_field",None))
+                ### default mandatory fields not required by the row's Test_Definition are only validated when given
+                elif mandatory in optional and mandatory not in mandatory_fields:
+                    missing_fields = True
+                    issues.append((mandatory,"missing_optional_field",None))
+        #### optional fields for row
+        for optional_field in optional_fields_found:
+            value = parsed_rows.get(optional_field,row_number)
+            if value is not None:
+                final_line.append(str(value))
+            else:
+                final_line.append("")
+                if optional_field in optional:
+                    missing_fields = True
+                    issues.append((optional_field,"missing_optional_field",None))
+
+        metadata_writer.writerow(final_line)
+
+        # record issues --- line numbers count the header line of the CSV
+        report.rows_checked = report.rows_checked + 1
+        if missing_fields is True:
+            warning_lines = warning_lines + 1
+        if len(issues) > 0:
+            row_sample = dict(zip(all_headers,final_line))
+            for field_of_interest,reason,value in issues:
+                report.add(field_of_interest,reason,row_number + 2,value=value,row=row_sample)
+
+    metadata_writer.close()
+    output_files = metadata_writer.output_files
+    if write_provenance is True:
+        provenance_csv = write_provenance_csv(f"{output_csv}.provenance.csv",subset_clarity_sample_data)
+        print(f"Source project/table of each sample written to {provenance_csv}")
+    if validation_report_file is None:
+        validation_report_file = f"{output_csv}.validation.json"
+    report.write(validation_report_file)
+    report.print_summary(validation_report_file)
+    return warning_lines,output_files
+
+############################################
+### Connected Insights domain and credentials (with workgroup) from the --ci_* options
+def get_ci_context(args):
+    CI_API_KEY = None
+    if args.ci_api_key_file is not None and os.path.isfile(args.ci_api_key_file) is True:
+        with open(args.ci_api_key_file, 'r') as f:
+            CI_API_KEY = str(f.read().strip("\n"))
+    ci_context = dict()
+    ci_context['domain_url'] = args.ci_domain_url
+    ci_context['auth_credentials'] = ci_upload.get_auth_credentials(args.ci_domain_url,CI_API_KEY,args.ci_username,args.ci_password)
+    ci_context['auth_credentials']['X-ILMN-Workgroup'] = ci_upload.resolve_workgroup_id(args.ci_domain_url,ci_context['auth_credentials'],args.workgroup_id,args.workgroup_name)
+    return ci_context
+
+### one value for every source, or a single value shared by all of them
+def per_source_values(values,number_of_sources,option_name):
+    if len(values) == 1:
+        return values * number_of_sources
+    if len(values) != number_of_sources:
+        raise ValueError(f"Please provide either one {option_name} or one per ICA project ({number_of_sources})")
+    return values
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--domain_name', default="bootcamp-ici", type=str, help="Connected Insights")
-    parser.add_argument('--project_id', default=None, type=str, help="ICA project id")
-    parser.add_argument('--project_name', default=None, type=str, help="ICA project name")
-    parser.add_argument('--sample_id', nargs='+', type=str, help="Sample Identifier to query from Clarity")
+    parser.add_argument('--project_id', nargs='+', default=[], type=str, help="ICA project id(s)")
+    parser.add_argument('--project_name', nargs='+', default=[], type=str, help="ICA project name(s)")
+    parser.add_argument('--sample_id', nargs='+', default=[], type=str, help="Sample Identifier to query from Clarity")
     parser.add_argument('--lims_sample_project', default=None, type=str, help="Clarity LIMS Sample project to query on")
     parser.add_argument('--output_csv', default=None, type=str, help="output CSV containing case metadata for Connected Insights")
-    parser.add_argument('--ica_root_url', default="https://ica.illumina.com", type=str, help="ICA root url. In most use-cases, this option does not need to be configured")
+    parser.add_argument('--output_format', nargs='+', default=["csv"], choices=["csv","parquet","arrow"], type=str, help="[OPTIONAL] metadata file format(s). Parquet/Arrow files are written next to the output CSV and need pyarrow")
+    parser.add_argument('--ica_root_url', nargs='+', default=["https://ica.illumina.com"], type=str, help="ICA root url. In most use-cases, this option does not need to be configured. Give one per project (project ids first, then project names) for projects in different regions")
     parser.add_argument('--api_key', default=None, type=str, help="A string that is the API Key")
-    parser.add_argument('--api_key_file', default=None, type=str, help="file that contains API Key")
+    parser.add_argument('--api_key_file', nargs='+', default=[], type=str, help="file that contains API Key. Give one per project (project ids first, then project names) for projects in different regions")
+    parser.add_argument('--base_table', nargs='+', default=["Clarity_SAMPLE_VIEW_tenant"], type=str, help="Base table(s) to query in each project")
+    parser.add_argument('--base_table_pattern', default=None, type=str, help="[OPTIONAL] also query every CLARITY Base table whose name matches this regular expression")
+    parser.add_argument('--max_workers', default=4, type=int, help="number of projects queried concurrently")
     parser.add_argument('--lenient_mode',  action="store_true", help="lenient mode crafting CSV for debugging")
+    parser.add_argument('--validation_report', default=None, type=str, help="[OPTIONAL] validation report file (.json or .csv). Default: <output_csv>.validation.json")
+    parser.add_argument('--validation_sample_limit', default=20, type=int, help="number of offending rows kept per field and reason in the validation report")
+    ### watch mode
+    parser.add_argument('--watch',  action="store_true", help="continuously poll Clarity for new samples and upload complete cases to Connected Insights")
+    parser.add_argument('--watch_lims_sample_projects', nargs='+', default=[], type=str, help="[OPTIONAL] Clarity LIMS Sample project(s) watch mode is scoped to")
+    parser.add_argument('--watch_state_file', default="clarity_watch_state.json", type=str, help="file storing the CREATE_TIME watermark and pending samples between watch cycles")
+    parser.add_argument('--watch_output_dir', default=".", type=str, help="directory for the metadata CSV of each uploaded micro-batch")
+    parser.add_argument('--poll_interval', default=300, type=int, help="seconds between watch cycles")
+    parser.add_argument('--batch_size', default=50, type=int, help="maximum number of cases per uploaded micro-batch")
+    parser.add_argument('--pending_max_age_hours', default=24, type=int, help="hours an incomplete sample is re-checked before watch mode gives up on it")
+    parser.add_argument('--ci_domain_url', default=None, type=str, help="Connected Insights domain URL (watch mode, Test_Definition fields)")
+    parser.add_argument('--ci_api_key_file', default=None, type=str, help="path to Connected Insights API key file (watch mode, Test_Definition fields)")
+    parser.add_argument('--ci_username', default=None, type=str, help="username [email] used to log into Connected Insights (watch mode, Test_Definition fields)")
+    parser.add_argument('--ci_password', default=None, type=str, help="password used to log into Connected Insights (watch mode, Test_Definition fields)")
+    parser.add_argument('--workgroup_id', default=None, type=str, help="[OPTIONAL] Connected Insights Workgroup ID (watch mode, Test_Definition fields)")
+    parser.add_argument('--workgroup_name', default=None, type=str, help="[OPTIONAL] Connected Insights Workgroup Name to grab Workgroup ID (watch mode, Test_Definition fields)")
+    parser.add_argument('--test_definition_cache', default="test_definition_cache.json", type=str, help="file caching the required and custom fields of the Test_Definitions of each Connected Insights workgroup")
+    parser.add_argument('--test_definition_ttl_hours', default=24, type=float, help="hours cached Test_Definitions are used before they are fetched again")
+    ### run journal
+    parser.add_argument('--run_id', default=None, type=str, help="[OPTIONAL] identifier of this run in the run journal")
+    parser.add_argument('--resume', default=None, type=str, help="run ID of an interrupted run to resume")
+    parser.add_argument('--journal_dir', default=".ci_metadata_runs", type=str, help="directory holding the run journals")
+    parser.add_argument('--rate_limit', nargs='+', default=[], type=str, help="[OPTIONAL] per host rate limits as host=requests_per_second[:burst]")
     args, extras = parser.parse_known_args()
     #############
     #######################
@@ -353,38 +899,62 @@ def main():
     LIMS_SAMPLE_PROJECT = None
     OUTPUT_CSV = None
     ################
-    os.environ['ICA_ROOT_URL'] = args.ica_root_url
-
-    if args.output_csv is not None:
-        OUTPUT_CSV = args.output_csv
-    else:
+    if args.output_csv is None and args.resume is None:
         dateTimeObj = dt.now()
         timestampStr = dateTimeObj.strftime("%Y%b%d_%H_%M_%S_%f")
-        OUTPUT_CSV = f"case_metadata.connected_insights.{timestampStr}.csv"
+        args.output_csv = f"case_metadata.connected_insights.{timestampStr}.csv"
+    ### the run journal (and its copy of the Clarity data) is only kept when asked for with --run_id or --resume.
+    ### Watch mode keeps its own state file instead
+    journal = None
+    if args.watch is False and (args.run_id is not None or args.resume is not None):
+        journal = run_journal.open_run_journal(args.journal_dir,args,run_id=args.resume or args.run_id,resume=args.resume is not None,parser=parser)
+    http_session.set_host_rate_limits(rate_limiter.parse_rate_limits(args.rate_limit))
+    OUTPUT_CSV = args.output_csv
+    os.environ['ICA_ROOT_URL'] = args.ica_root_url[0]
     
     # Argument checks for API KEY
-    if args.api_key is None and args.api_key_file is None:
+    API_KEYS = []
+    if args.api_key is None and len(args.api_key_file) < 1:
         raise ValueError("Please provide either a project id (--api_key) or project name (--api_key_file)")
-    elif args.api_key is None and args.api_key_file is not None:
-        if os.path.isfile(args.api_key_file) is True:
-            with open(args.api_key_file, 'r') as f:
-                API_KEY = str(f.read().strip("\n"))
+    elif args.api_key is None and len(args.api_key_file) > 0:
+        for api_key_file in args.api_key_file:
+            if os.path.isfile(api_key_file) is True:
+                with open(api_key_file, 'r') as f:
+                    API_KEYS.append(str(f.read().strip("\n")))
     else:
-        API_KEY = args.api_key
-    ## Validate API_KEY    
-    if validate_api_key(API_KEY) is True:
-        print(f"[Pre-Flight-Check] Authentication via API KEY passed on ICA")
+        API_KEYS = [args.api_key]
 
     # Argument checks for PROJECT ID/NAME
-    if args.project_id is None and args.project_name is None:
+    if len(args.project_id) < 1 and len(args.project_name) < 1:
         raise ValueError("Please provide either a project id (--project_id) or project name (--project_name)")
-    elif args.project_id is None and args.project_name is not None:
-        PROJECT_ID = get_project_id(API_KEY, PROJECT_NAME)
-    else:
-        PROJECT_ID = args.project_id
-    # Check if Project is valid
-    if valid_project_id(API_KEY,PROJECT_ID) is True:
-        print(f"[Pre-Flight-Check] ICA Project is valid and accessible to user")
+    project_identifiers = [(project_id,None) for project_id in args.project_id] + [(None,project_name) for project_name in args.project_name]
+    ica_root_urls = per_source_values(args.ica_root_url,len(project_identifiers),"--ica_root_url")
+    API_KEYS = per_source_values(API_KEYS,len(project_identifiers),"--api_key_file")
+    sources = []
+    for idx,(project_id,project_name) in enumerate(project_identifiers):
+        sources.append({"project_id": project_id, "project_name": project_name, "ica_root_url": ica_root_urls[idx], "api_key": API_KEYS[idx]})
+    ## Validate API_KEY(s), unless this is a resumed run that already has its Clarity data
+    if run_journal.step_completed(journal,"load_clarity_data") is False:
+        for api_key,ica_root_url in set([(source['api_key'],source['ica_root_url']) for source in sources]):
+            if validate_api_key(api_key,ica_root_url) is True:
+                print(f"[Pre-Flight-Check] Authentication via API KEY passed on ICA {ica_root_url}")
+
+    # Watch mode: keep generating and uploading metadata for new samples until signalled to stop
+    if args.watch is True:
+        if len(sources) > 1:
+            raise ValueError("Watch mode supports a single ICA project")
+        API_KEY = sources[0]['api_key']
+        PROJECT_ID = sources[0]['project_id']
+        if PROJECT_ID is None:
+            PROJECT_ID = get_project_id(API_KEY, sources[0]['project_name'], sources[0]['ica_root_url'])
+        if valid_project_id(API_KEY,PROJECT_ID,sources[0]['ica_root_url']) is True:
+            print(f"[Pre-Flight-Check] ICA Project is valid and accessible to user")
+        if args.ci_domain_url is None:
+            raise ValueError("Please provide the Connected Insights domain URL (--ci_domain_url) to use watch mode")
+        ci_context = get_ci_context(args)
+        os.makedirs(args.watch_output_dir, exist_ok=True)
+        run_watch_mode(API_KEY,PROJECT_ID,ci_context,ica_root_url=sources[0]['ica_root_url'],base_table_of_interest=args.base_table[0],lims_sample_projects=args.watch_lims_sample_projects,watch_state_file=args.watch_state_file,poll_interval=args.poll_interval,batch_size=args.batch_size,output_dir=args.watch_output_dir,pending_max_age_hours=args.pending_max_age_hours,test_definition_cache=args.test_definition_cache,test_definition_ttl_hours=args.test_definition_ttl_hours)
+        return
 
     # Argument checks for Samples/Projects we'll generate a metadata samplesheet for case ingestion into Connected Insights
     if len(args.sample_id) < 1 and args.lims_sample_project is None:
@@ -397,140 +967,41 @@ def main():
         LIMS_SAMPLE_PROJECT = args.lims_sample_project
         print(f"[Pre-Flight-Check] Generating metadata for Connected Insights using samples from this project in Clarity LIMS: {LIMS_SAMPLE_PROJECT}")
 
-    # STEP 1: Get ICA base connection details
-    print(f"STEP 1: Get ICA Base connection details")
-    ica_base_table_metadata = get_base_tables(API_KEY,PROJECT_ID)
-    if base_table_sanity_check(ica_base_table_metadata) is True:
-        ICA_base_connection_details = get_ica_base_connection(API_KEY,PROJECT_ID)
+    # STEP 1 - STEP 3: per project, get ICA base connection details, connect to the Snowflake Warehouse and query the Base table(s)
+    base_tables_str = ", ".join(args.base_table)
+    print(f"STEP 1 - STEP 3: Loading data from Base table(s) {base_tables_str} in {len(sources)} ICA project(s)")
+    if run_journal.step_completed(journal,"load_clarity_data") is True:
+        clarity_sample_data = pd.read_pickle(journal['steps']['load_clarity_data']['clarity_data_file'])
+        print(f"[Resume] Loaded Clarity data fetched earlier in this run")
     else:
-        raise ValueError(f"Does your project {PROJECT_ID} have Base tables from the Data Catalogue in them?")
-
-    # STEP 2: Create Snowflake connector object and connect to Warehouse
-    snowflake_connector_object = connect_to_snowflake(ICA_base_connection_details)
-    print(f"STEP 2: Connecting to Snowflake Warehouse {ICA_base_connection_details['databaseName']}")
-    snowflake_connector_object.cursor().execute(f"USE {ICA_base_connection_details['databaseName']}")
-
-    # STEP 3: Query Clarity_SAMPLE_VIEW_tenant table
-    print(f"STEP 3: Loading data from Base table Clarity_SAMPLE_VIEW_tenant")
-    clarity_sample_data = load_clarity_sample_table(snowflake_connector_object = snowflake_connector_object,  base_table_of_interest = "Clarity_SAMPLE_VIEW_tenant")
-
-    # STEP 4: Subset view by sample id(s) or by LIMS_SAMPLE_PROJECT
-    print(f"STEP 4: Subsetting Sample metadata by sample ID or Clarity LIMS project name")
-    if len(SAMPLE_ID) < 1 and LIMS_SAMPLE_PROJECT is not None:
-        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = [], clarity_lims_sample_project = LIMS_SAMPLE_PROJECT)
-    elif len(SAMPLE_ID) > 0 and LIMS_SAMPLE_PROJECT is None:
-        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = SAMPLE_ID, clarity_lims_sample_project = None)
-    elif len(SAMPLE_ID) > 0 and LIMS_SAMPLE_PROJECT is not None:
-        subset_clarity_sample_data = subset_clarity_sample_view(clarity_sample_data = clarity_sample_data, sample_ids = SAMPLE_ID, clarity_lims_sample_project = LIMS_SAMPLE_PROJECT)
-
-
-    # STEP 5: Sanity check we have all mandatory fields for ingestion ;  warning for missing (optional + custom) fields
-    print(f"STEP 5: Checking Sample data of interest to see if we have data of interest")
-    # First pass --- collect info
-    initial_data_for_metadata_csv = []
-    table_mandatory_fields = []
-    table_optional_fields = []
-    for idx,r in enumerate(subset_clarity_sample_data):
-        parsed_objects = parse_table_row(r)
-        table_mandatory_fields = table_mandatory_fields + list(parsed_objects[0].keys())
-        table_optional_fields = table_optional_fields + list(parsed_objects[1].keys())
-        initial_data_for_metadata_csv.append(list(parsed_objects))
-
-    # second pass form lines based on minimal set of info mandatory fields and union of optional_fields --- if optional fields is empty, ignore
-    mandatory_fields_found = list(set(table_mandatory_fields))
-    optional_fields_found = list(set(table_optional_fields))
-    if len(mandatory_fields_found) == 0 and len(optional_fields_found) == 0:
-        raise ValueError(f"Could not find any fields on interest")
-    elif len(mandatory_fields_found) == 0:    
-        mandatory_fields_str = ", ".join(mandatory_fields)
-        raise ValueError(f"Could not find any of the mandatory fields on interest {mandatory_fields_str}")
-    
-    warning_lines = 0
-    final_data_for_metadata_csv = []
-    if len(optional_fields_found) > 0 :
-        all_headers = mandatory_fields + optional_fields_found
+        clarity_sample_data = load_clarity_sources(sources,base_tables=args.base_table,base_table_pattern=args.base_table_pattern,max_workers=args.max_workers)
+        if journal is not None:
+            clarity_data_file = os.path.join(journal['run_directory'], "clarity_sample_data.pkl")
+            clarity_sample_data.to_pickle(clarity_data_file)
+            run_journal.complete_step(journal,"load_clarity_data",files=[clarity_data_file],clarity_data_file=clarity_data_file)
+
+    # STEP 4 - STEP 6: Subset, check fields of interest and write the metadata CSV
+    validation_report_file = args.validation_report
+    if validation_report_file is None:
+        validation_report_file = f"{OUTPUT_CSV}.validation.json"
+    if run_journal.step_completed(journal,"generate_metadata_csv") is True:
+        warning_lines = journal['steps']['generate_metadata_csv']['warning_lines']
+        print(f"[Resume] {OUTPUT_CSV} was already generated")
     else:
-        all_headers = mandatory_fields
-    all_headers_str = ",".join(all_headers)
-    final_data_for_metadata_csv.append(all_headers_str)
-    for r in initial_data_for_metadata_csv:
-        final_line = []
-        missing_mandatory_fields = []
-        missing_mandatory_flag = 0
-        missing_optional_fields = []
-        missing_optional_flag = 0
-        invalid_tumor_type_flag = 0
-        invalid_field_value_flag = 0
-        invalid_field_values = []
-        #### mandatory fields for row
-        if len(r[0]) > 0 :
-            for mandatory in mandatory_fields:
-                if mandatory in r[0].keys():
-                    final_line.append(r[0][mandatory])
-                    if mandatory == "Tumor_Type":
-                        if snomedct_id_validation(snowmedct_id=r[0][mandatory]) is False:
-                            invalid_tumor_type_flag = invalid_tumor_type_flag + 1
-                    if mandatory in list(field_validate_dict.keys()):
-                        if field_validator(mandatory,r[0][mandatory]) is None:
-                            print(f"[Info] Skipping validation for {mandatory}")
-                        elif field_validator(mandatory,r[0][mandatory]) is False:
-                            invalid_field_value_flag = invalid_field_value_flag + 1
-                            invalid_field_values.append(mandatory)
-                else:
-                    missing_mandatory_flag = missing_mandatory_flag + 1
-                    final_line.append("")
-                    missing_mandatory_fields.append(mandatory)
-        else:
-            for mandatory in mandatory_fields:
-                final_line.append("")
-                missing_mandatory_fields.append(mandatory)
-         #### optional fields for row
-        if len(optional_fields_found) > 0:
-            if len(r[1]) > 0:
-                for optional in optional_fields_found:
-                    if optional in r[1].keys():
-                        final_line.append(r[1][optional])
-                    else:
-                        missing_optional_fields = missing_optional_fields + 1
-                        final_line.append("")
-                        missing_optional_fields.append(optional)
-            else:
-                for optional in optional_fields:
-                    final_line.append("")
-                    missing_optional_fields.append(optional)       
-
-        # final line
-        line_str = ",".join(final_line) 
-        final_data_for_metadata_csv.append(line_str)
-
-        # print out warnings
-        if missing_optional_flag > 0 or missing_mandatory_flag > 0:
-            warning_lines = warning_lines + 1
-        if len(missing_mandatory_fields) > 0:
-            missing_mandatory_fields_str = ",".join(missing_mandatory_fields)
-            print(f"[Warning] Missing Mandatory fields {missing_mandatory_fields_str} in line {line_str}")
-        if len(missing_optional_fields) > 0:
-            missing_optional_fields_str = ",".join(missing_optional_fields)
-            print(f"[Warning] Missing Optional fields {missing_optional_fields_str} in line {line_str}")
-        if invalid_tumor_type_flag > 0:
-            print(f"[Warning] Invalid SNOWMEDCT Identifier provided for Tumor_Type in line {line_str}")
-        if len(invalid_field_values) > 0:
-            for invalid_value in invalid_field_values:
-                valid_values_str = ', '.join(field_validate_dict[invalid_value])
-                print(f"[Warning] Invalid Value for field {invalid_value} in line {line_str}")
-                print(f"[Warning] Expected value to be one of the following: [ {valid_values_str} ]")
-
-    # STEP 6: Generate metadata CSV
-    print(f"STEP 6: Creating metadata CSV for ingestion into Connected Insights")
-    all_lines = "\n".join(final_data_for_metadata_csv)
-    with open(f"{OUTPUT_CSV}", "w") as outfile:
-        outfile.write(f"{all_lines}")
-
+        ### with a Connected Insights workgroup, each row is checked against the fields of its Test_Definition
+        row_extractor = None
+        if args.ci_domain_url is not None:
+            row_extractor = load_row_extractor(None,args.test_definition_cache,args.test_definition_ttl_hours,args=args)
+        write_provenance = len(sources) > 1 or args.base_table_pattern is not None or len(args.base_table) > 1
+        warning_lines,output_files = generate_case_metadata(clarity_sample_data,SAMPLE_ID,LIMS_SAMPLE_PROJECT,OUTPUT_CSV,write_provenance,args.output_format,validation_report_file,args.validation_sample_limit,row_extractor)
+        run_journal.complete_step(journal,"generate_metadata_csv",files=output_files,output_csv=OUTPUT_CSV,warning_lines=warning_lines)
+
+    http_session.report()
     if args.lenient_mode is True:
-        print(f"There are {warning_lines} to fix in the file {OUTPUT_CSV}.\nSee warnings above.")
+        print(f"There are {warning_lines} to fix in the file {OUTPUT_CSV}.\nSee {validation_report_file}")
     else:
         if warning_lines > 0:
-            raise ValueError(f"There are {warning_lines} lines to fix in the file {OUTPUT_CSV}.\nSee warnings above.")
+            raise ValueError(f"There are {warning_lines} lines to fix in the file {OUTPUT_CSV}.\nSee {validation_report_file}")
     # TUMOR_TYPE check ?
     # check that SNOWMED IDENTIFIER is valid/active
     # curl -X 'GET' 'https://browser.ihtsdotools.org/snowstorm/snomed-ct/MAIN/SNOMEDCT-US/2024-03-01/concepts?offset=0&limit=100&termActive=true&ecl=707405009'
@@ -1,11 +1,23 @@
 from pprint import pprint
-import requests
 from requests.structures import CaseInsensitiveDict
 import json
 import os
 import argparse
 import base64
-import sys
+import time
+import csv
+import hashlib
+import run_journal
+import rate_limiter
+import metadata_table
+import validation_report
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from datetime import timedelta
+
+### one HTTP session per process, so repeated calls (e.g. watch mode) reuse warm connections.
+### It is rate limited per host and shared with the Clarity/ICA script when that one imports this module
+http_session = rate_limiter.RateLimitedSession()
 # STEP 1: generate psToken from username and password
 def generate_ps_token(platform_url,application_name,domain_url,credentials):
     platform_services_url = f"{platform_url}/platform-services-manager/Session/"
@@ -20,14 +32,14 @@ def generate_ps_token(platform_url,application_name,domain_url,credentials):
     }
     access_token = None
     try:
-        platform_response = requests.post(platform_services_url, headers=headers,data=json.dumps(data))
+        platform_response = http_session.post(platform_services_url, headers=headers,data=json.dumps(data))
         platform_response_json = platform_response.json()
         if 'access_token' not in list(platform_response_json.keys()):
             pprint(json.dumps(platform_response_json),indent=4)
         else:
             access_token = platform_response.json()['access_token']
     except:
-        platform_response = requests.post(platform_services_url, headers=headers,data=json.dumps(data))
+        platform_response = http_session.post(platform_services_url, headers=headers,data=json.dumps(data))
         pprint(platform_response,indent=4)
         raise ValueError(f"Could not generate psToken for the following URL: {domain_url}")
     return access_token    
@@ -39,7 +51,7 @@ def get_workgroup_metadata_v2(domain_url,headers):
     data = {}
     data["rURL"] = f"{domain_url}/crs/api/v1/session/workgroups"
     #print(new_url)
-    r = requests.get(new_url,headers=headers,data=json.dumps(data),stream=True,allow_redirects=False)
+    r = http_session.get(new_url,headers=headers,data=json.dumps(data),stream=True,allow_redirects=False)
     print(f"HTTP/{r.raw.version/10} {r.raw.status} {r.raw.reason}")
     for k,v in r.raw.headers.items(): 
         #print(f"{k}: {v}")
@@ -61,7 +73,7 @@ def get_workgroup_id(domain_url,auth_credentials,workgroup_name=None):
     headers['User-Agent'] = auth_credentials['User-Agent']
     workgroup_id = None
     try:
-        connected_insights_response = requests.get(full_url, headers=headers)
+        connected_insights_response = http_session.get(full_url, headers=headers)
         print(connected_insights_response.request.headers)
         #print(connected_insights_response.text)
         ### pick first workgroup observed if no workgroup name given
@@ -76,7 +88,7 @@ def get_workgroup_id(domain_url,auth_credentials,workgroup_name=None):
                     workgroup_name = workgroup['orgName'] 
         print(f"Found workgroup id {workgroup_id} associated to the workgroup name {workgroup_name}")
     except:
-        connected_insights_response = requests.get(full_url, headers=headers)
+        connected_insights_response = http_session.get(full_url, headers=headers)
         pprint(connected_insights_response,indent=4)
         header_response = get_workgroup_metadata_v2(domain_url,headers)
         pprint(header_response,indent=4)
@@ -110,7 +122,7 @@ def get_diseases_configured(domain_url,auth_credentials):
     headers['X-ILMN-Workgroup'] = auth_credentials['X-ILMN-Workgroup']
     headers['User-Agent'] = auth_credentials['User-Agent']
     try:
-        diseases_configured = requests.get(full_url, headers=headers)
+        diseases_configured = http_session.get(full_url, headers=headers)
         #print(diseases_configured.request.headers)
         #print(diseases_configured.status_code)
         #print(diseases_configured.reason)
@@ -124,7 +136,7 @@ def get_diseases_configured(domain_url,auth_credentials):
                             synonym_string = ", ".join(term['synonym'])
                             valid_snowmedct_ids[str(term['externalId'])] = f"{synonym_string}"
     except:
-        diseases_configured = requests.get(full_url, headers=headers)
+        diseases_configured = http_session.get(full_url, headers=headers)
         print(diseases_configured.request.headers)
         print(diseases_configured.status_code)
         print(diseases_configured.reason)
@@ -133,27 +145,84 @@ def get_diseases_configured(domain_url,auth_credentials):
         raise ValueError(f"Could not get diseases configured for {domain_url}")
     return valid_snowmedct_ids
 
-def validate_tumor_types_in_csv(ids_of_interest,metadata_csv):
-    validation_object = dict()
-    with open(metadata_csv,"r") as open_file:
-        for line_num,line in enumerate(open_file.readlines()):
-            line_cleaned = line.rstrip()
-            line_split = line_cleaned.split(',')
-            line_split = [str(x) for x in line_split]
-            if 'Tumor_Type' in line_split:
-                for idx,field in enumerate(line_split):
-                    if field == "Tumor_Type":
-                        field_num_of_interest = idx
-            else:
-                # Create warning message if provided SNOWMEDCT ID is not found in Connected Insights workgroup configuration
-                if line_split[field_num_of_interest] not in ids_of_interest:
-                    ids_of_interest_str = ", ".join(ids_of_interest)
-                    warning_str = f"[Warning] Could not find a valid Tumor_Type in line [Line number {str(line_num)}] {line}\nFound the following id: {line_split[field_num_of_interest]}\nExpected one of these SNOWMEDCT IDs: {ids_of_interest_str}\n"
-                    validation_object[f"Line {str(line_num)}"] = warning_str
-    return validation_object
+### Required and custom (optional) case metadata fields of every Test_Definition configured in the workgroup
+def get_test_definitions_configured(domain_url,auth_credentials):
+    test_definitions = dict()
+    endpoint_url = f"/cfg/api/v1/test-definitions"
+    full_url = domain_url + endpoint_url
+    headers = CaseInsensitiveDict()
+    headers['accept'] = 'application/json'
+    headers['Content-Type'] = 'application/json'
+    headers['X-ILMN-Domain'] = auth_credentials['X-ILMN-Domain']
+    headers['Authorization'] = auth_credentials['Authorization']
+    headers['X-ILMN-Workgroup'] = auth_credentials['X-ILMN-Workgroup']
+    headers['User-Agent'] = auth_credentials['User-Agent']
+    try:
+        test_definitions_configured = http_session.get(full_url, headers=headers)
+        test_definitions_items = json.loads(test_definitions_configured.text)
+        ### paged responses keep the test definitions under 'content'
+        if isinstance(test_definitions_items, dict):
+            test_definitions_items = test_definitions_items['content']
+        for item in test_definitions_items:
+            test_definition_name = item.get('name') or item.get('testDefinitionName')
+            if test_definition_name is None:
+                continue
+            required_fields = []
+            custom_fields = []
+            for field in (item.get('caseMetadataFields') or item.get('fields') or []):
+                field_name = field.get('name') or field.get('fieldName')
+                if field_name is None:
+                    continue
+                if field.get('required') is True:
+                    required_fields.append(field_name)
+                else:
+                    custom_fields.append(field_name)
+            test_definitions[test_definition_name] = {"required_fields": required_fields, "custom_fields": custom_fields}
+    except:
+        test_definitions_configured = http_session.get(full_url, headers=headers)
+        print(test_definitions_configured.status_code)
+        print(test_definitions_configured.reason)
+        print(test_definitions_configured.text)
+        raise ValueError(f"Could not get Test_Definitions configured for {domain_url}")
+    return test_definitions
+
+### Test_Definitions are cached per domain and workgroup in cache_file and only fetched again once older than ttl_hours
+def get_test_definitions_cached(domain_url,auth_credentials,cache_file="test_definition_cache.json",ttl_hours=24):
+    cache_key = f"{domain_url}|{auth_credentials['X-ILMN-Workgroup']}"
+    cache = dict()
+    if os.path.isfile(cache_file) is True:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    cache_entry = cache.get(cache_key)
+    if cache_entry is not None and dt.fromisoformat(cache_entry['fetched']) > dt.now() - timedelta(hours=ttl_hours):
+        return cache_entry['test_definitions']
+    print(f"[Test-Definition] Fetching Test_Definitions configured for workgroup {auth_credentials['X-ILMN-Workgroup']} in {domain_url}")
+    test_definitions = get_test_definitions_configured(domain_url,auth_credentials)
+    cache[cache_key] = {"fetched": dt.now().isoformat(), "test_definitions": test_definitions}
+    tmp_file = f"{cache_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+    return test_definitions
+
+### Issues are added to report; the configured SNOWMEDCT IDs are recorded once as the expected values of Tumor_Type
+def validate_tumor_types_in_csv(ids_of_interest,metadata_csv,report=None):
+    if report is None:
+        report = validation_report.ValidationReport(metadata_csv)
+    report.set_expected_values("Tumor_Type",ids_of_interest)
+    ids_of_interest = set(ids_of_interest)
+    headers,rows = metadata_table.read_metadata_table(metadata_csv)
+    report.rows_checked = len(rows)
+    # line numbers count the header line of the CSV
+    for line_num,row in enumerate(rows,start=2):
+        # Record an issue if provided SNOWMEDCT ID is not found in Connected Insights workgroup configuration
+        if row['Tumor_Type'] not in ids_of_interest:
+            report.add("Tumor_Type","not_configured_in_workgroup",line_num,value=row['Tumor_Type'],row=row)
+    return report
 
 # Validation STEP 2B: Check if cases in CSV intersect with Case_IDs present in in Connected Insights 
-def get_cases_present(domain_url,auth_credentials):
+### include_metadata=True keeps the whole case record instead of only its status (used by delta mode)
+def get_cases_present(domain_url,auth_credentials,include_metadata=False):
     current_cases = dict()
     page_size = 1000
     pages_parsed = 0
@@ -166,43 +235,110 @@ def get_cases_present(domain_url,auth_credentials):
     headers['Authorization'] = auth_credentials['Authorization']
     headers['X-ILMN-Workgroup'] = auth_credentials['X-ILMN-Workgroup']
     try:
-        cases_present = requests.get(full_url, headers=headers)
+        cases_present = http_session.get(full_url, headers=headers)
         cases_present_items = json.loads(cases_present.text)
         total_cases = cases_present_items['totalElements']
         while total_cases > (pages_parsed * page_size):
             #print(f"hi {cases_present_items['totalElements']}")
             for idx,case in enumerate(cases_present_items['content']):
-                current_cases[case['displayId']] = case['status']
+                if include_metadata is True:
+                    current_cases[case['displayId']] = case
+                else:
+                    current_cases[case['displayId']] = case['status']
             pages_parsed = pages_parsed + 1
             endpoint_url = f"/crs/api/v1/cases/search?pageNumber={pages_parsed}&pageSize={page_size}"
             full_url = domain_url + endpoint_url
-            cases_present = requests.get(full_url, headers=headers)
+            cases_present = http_session.get(full_url, headers=headers)
             cases_present_items = json.loads(cases_present.text)
             #print(f"done {pages_parsed * page_size}")
     except:
-        cases_present = requests.get(full_url, headers=headers)
+        cases_present = http_session.get(full_url, headers=headers)
         pprint(json.loads(cases_present.text),indent = 4)
         raise ValueError(f"Could not get cases present for {domain_url}")
     return current_cases
 
-def validate_case_id_in_csv(ids_of_interest,metadata_csv):
-    validation_object = dict()
-    with open(metadata_csv,"r") as open_file:
-        for line_num,line in enumerate(open_file.readlines()):
-            line_cleaned = line.rstrip()
-            line_split = line_cleaned.split(',')
-            line_split = [str(x) for x in line_split]
-            if 'Case_ID' in line_split:
-                for idx,field in enumerate(line_split):
-                    if field == "Case_ID":
-                        field_num_of_interest = idx
+def validate_case_id_in_csv(ids_of_interest,metadata_csv,report=None):
+    if report is None:
+        report = validation_report.ValidationReport(metadata_csv)
+    ids_of_interest = set(ids_of_interest)
+    headers,rows = metadata_table.read_metadata_table(metadata_csv)
+    report.rows_checked = len(rows)
+    for line_num,row in enumerate(rows,start=2):
+        # Record an issue if provided Case ID is already found in this Connected Insights workgroup --- this may impact the ingestion of this case
+        if row['Case_ID'] in ids_of_interest:
+            report.add("Case_ID","already_in_workgroup",line_num,value=row['Case_ID'],row=row)
+    return report
+
+# Delta mode: only upload the cases that are new or changed since they were last uploaded
+def group_rows_by_case(rows):
+    case_rows_by_id = dict()
+    for row in rows:
+        case_rows_by_id.setdefault(row["Case_ID"], []).append(row)
+    return case_rows_by_id
+
+def load_fingerprint_store(fingerprint_store):
+    fingerprints = dict()
+    if os.path.isfile(fingerprint_store) is True:
+        with open(fingerprint_store, 'r') as f:
+            fingerprints = json.load(f)
+    return fingerprints
+
+def save_fingerprint_store(fingerprint_store,fingerprints):
+    tmp_file = f"{fingerprint_store}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(fingerprints, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, fingerprint_store)
+
+### one fingerprint per case, over every row (sample) of the case and independent of row/column order
+def case_fingerprint(case_rows):
+    canonical_rows = sorted([json.dumps(row, sort_keys=True) for row in case_rows])
+    return hashlib.sha256("\n".join(canonical_rows).encode("utf-8")).hexdigest()
+
+### Compare CSV values with the fields Connected Insights returns for the case (matched on name, ignoring case and '_').
+### Returns None when the case record has none of the CSV fields, so nothing can be concluded
+def ci_case_matches_rows(case_record,case_rows):
+    normalized_record = dict()
+    for k,v in case_record.items():
+        if isinstance(v, (str, int, float)):
+            normalized_record[k.lower().replace("_", "")] = str(v)
+    fields_compared = 0
+    for row in case_rows:
+        for field,value in row.items():
+            normalized_field = field.lower().replace("_", "")
+            if field == "Case_ID" or normalized_field not in normalized_record.keys():
+                continue
+            fields_compared = fields_compared + 1
+            if normalized_record[normalized_field] != value:
+                return False
+    if fields_compared == 0:
+        return None
+    return True
+
+def plan_delta_upload(case_rows_by_id,cases_present_metadata,workgroup_fingerprints):
+    delta_plan = {"new": [], "changed": [], "unchanged": []}
+    for case_id,case_rows in case_rows_by_id.items():
+        fingerprint = case_fingerprint(case_rows)
+        if case_id not in cases_present_metadata.keys():
+            delta_plan["new"].append(case_id)
+        elif case_id in workgroup_fingerprints.keys():
+            if workgroup_fingerprints[case_id] == fingerprint:
+                delta_plan["unchanged"].append(case_id)
             else:
-                # Create warning message if provided Case ID is already found in this Connected Insights workgroup
-                if line_split[field_num_of_interest] in ids_of_interest:
-                    ids_of_interest_str = ", ".join(ids_of_interest)
-                    warning_str = f"[Warning] Found Case_ID in line [Line number {str(line_num)}] {line}\nFound the following id: {line_split[field_num_of_interest]}\nThis may impact the ingestion of this case\n"
-                    validation_object[f"Line {str(line_num)}"] = warning_str
-    return validation_object
+                delta_plan["changed"].append(case_id)
+        elif ci_case_matches_rows(cases_present_metadata[case_id],case_rows) is True:
+            delta_plan["unchanged"].append(case_id)
+            workgroup_fingerprints[case_id] = fingerprint
+        else:
+            delta_plan["changed"].append(case_id)
+    return delta_plan
+
+def write_delta_csv(delta_csv,headers,case_rows_by_id,case_ids):
+    with open(delta_csv, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=headers)
+        writer.writeheader()
+        for case_id in case_ids:
+            writer.writerows(case_rows_by_id[case_id])
+    return delta_csv
 
 # STEP 3: Upload Case Metadata into Connected Insights
 def upload_case_metadata(domain_url,auth_credentials,metadata_csv):
@@ -213,12 +349,14 @@ def upload_case_metadata(domain_url,auth_credentials,metadata_csv):
     headers['X-Ilmn-Domain'] = auth_credentials['X-ILMN-Domain']
     headers['X-Ilmn-Workgroup'] = auth_credentials['X-ILMN-Workgroup']
     headers['Authorization'] = auth_credentials['Authorization']
+    ### Parquet/Arrow metadata is converted to CSV for ingestion
+    metadata_csv = metadata_table.metadata_csv_for_upload(metadata_csv)
     input_file = os.path.basename(f"{metadata_csv}")
     files = {'files' : (f"{input_file}", open(f"{metadata_csv}", 'rb'), 'text/csv') }
     metadata_csv_ingestion_response = None
     file_id = None
     try:
-        metadata_csv_ingestion_response = requests.post(full_url, headers=headers,files=files)
+        metadata_csv_ingestion_response = http_session.post(full_url, headers=headers,files=files)
         #pprint(metadata_csv_ingestion_response.text,indent=4)
         file_id = json.loads(metadata_csv_ingestion_response.text)[0]['id']
         #pprint(metadata_csv_ingestion_response.text,indent=4)
@@ -239,26 +377,238 @@ def case_metadata_ingestion_check(domain_url,auth_credentials,file_id):
     headers['Authorization'] = auth_credentials['Authorization']
     ingestion_status = None
     try:
-        ingestion_status = requests.get(full_url, headers=headers)
+        ingestion_status = http_session.get(full_url, headers=headers)
         pprint(ingestion_status.text,indent=4)
     except:
         pprint(ingestion_status,indent=4)
-        raise ValueError(f"Could not ingest {ingestion_status['source']}")
+        raise ValueError(f"Could not check the ingestion status of file {file_id}")
     return json.loads(ingestion_status.text)
+### Build the header values shared by all Connected Insights requests
+def get_auth_credentials(domain_url,api_key=None,username=None,password=None,application_name="connectedinsights",platform_url="https://platform.login.illumina.com"):
+    auth_credentials = dict()
+    if api_key is None:
+        ## base64 encode username password combination
+        encoded_key = base64.b64encode(bytes(f"{username}:{password}", "utf-8")).decode()
+        ps_token = generate_ps_token(platform_url,application_name,domain_url,encoded_key)
+        auth_credentials['Authorization'] = f"{ps_token}"
+    else:
+        auth_credentials['Authorization'] = f"ApiKey {api_key}"
+    auth_credentials['User-Agent'] = "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Mobile Safari/537.36"
+    auth_credentials['X-ILMN-Domain'] = domain_url.strip("https://").split(".")[0]
+    return auth_credentials
+
+def resolve_workgroup_id(domain_url,auth_credentials,workgroup_id=None,workgroup_name=None):
+    if workgroup_name is not None:
+        workgroup_id = get_workgroup_id(domain_url,auth_credentials,workgroup_name)
+    elif workgroup_id is None:
+        workgroup_id = get_workgroup_id(domain_url,auth_credentials)
+    if workgroup_id is None:
+        raise ValueError(f"Could not find workgroup id in the domain {domain_url}")
+    return workgroup_id
+
+### poll STEP 4 until Connected Insights is done with the file
+def wait_for_ingestion(domain_url,auth_credentials,file_id,poll_interval=0):
+    ingestion_status = "QUEUED"
+    ingestion_metadata = None
+    while ingestion_status in ["QUEUED","IN_PROGRESS"]:
+        if ingestion_metadata is not None and poll_interval > 0:
+            time.sleep(poll_interval)
+        ingestion_metadata = case_metadata_ingestion_check(domain_url,auth_credentials,file_id)
+        ingestion_status = ingestion_metadata['status']
+    return ingestion_metadata
+### Validation STEP 2A + 2B
+### configured_snowmedct_ids / cases_present_in_ici can be passed in when they were already fetched for the workgroup.
+### Issues of both steps go to one validation report (default: <metadata_csv>.validation.json) before anything is raised
+def validate_metadata_csv(domain_url,auth_credentials,metadata_csv,lenient_mode=False,delta_mode=False,configured_snowmedct_ids=None,cases_present_in_ici=None,validation_report_file=None,validation_sample_limit=20):
+    report = validation_report.ValidationReport(metadata_csv,sample_limit=validation_sample_limit)
+    print(f"Validating Tumor_Type in Case Metadata file {metadata_csv}")
+    if configured_snowmedct_ids is None:
+        configured_disease_terms = get_diseases_configured(domain_url,auth_credentials)
+        configured_snowmedct_ids = list(configured_disease_terms.keys())
+    validate_tumor_types_in_csv(configured_snowmedct_ids,metadata_csv,report)
+    
+    # Validation STEP 2B: Check if cases in CSV intersect with Case_IDs present in in Connected Insights 
+    # (in delta mode, cases already present are the changed ones and are meant to be re-uploaded)
+    if delta_mode is False:
+        print(f"Validating Case_IDs in Case Metadata file {metadata_csv}")
+        if cases_present_in_ici is None:
+            cases_present_in_ici_metadata = get_cases_present(domain_url,auth_credentials)
+            cases_present_in_ici = list(cases_present_in_ici_metadata.keys())
+        validate_case_id_in_csv(cases_present_in_ici,metadata_csv,report)
+
+    if validation_report_file is None:
+        validation_report_file = f"{metadata_csv}.validation.json"
+    report.write(validation_report_file)
+    report.print_summary(validation_report_file)
+    if lenient_mode is False:
+        if report.count(field="Tumor_Type") > 0:
+            raise ValueError(f"Invalid Tumor Type(s) supplied to {metadata_csv}. See {validation_report_file}")
+        if report.count(field="Case_ID") > 0:
+            raise ValueError(f"Case ID already found in Connected Insights.\nEither modify {metadata_csv} with unique case identifiers or delete case and re-ingest metadata. See {validation_report_file}")
+    return report
+
+### Batch mode: upload every (CSV, domain, workgroup) entry of a manifest
+def read_manifest(manifest):
+    with open(manifest, "r", newline="") as open_file:
+        entries = [entry for entry in csv.DictReader(open_file)]
+    for line_num,entry in enumerate(entries):
+        for column in ["metadata_csv","domain_url"]:
+            if entry.get(column) is None or entry[column] == "":
+                raise ValueError(f"Missing {column} in line {line_num + 2} of the manifest {manifest}")
+    return entries
+
+def read_api_key_file(api_key_file):
+    API_KEY = None
+    if api_key_file is not None and os.path.isfile(api_key_file) is True:
+        with open(api_key_file, 'r') as f:
+            API_KEY = str(f.read().strip("\n"))
+    return API_KEY
+
+### Authenticate once per domain and fetch the disease config and cases once per workgroup.
+### An entry whose domain or workgroup cannot be resolved gets an 'error' instead of a 'workgroup_key'
+def resolve_manifest_workgroups(entries,api_key_file=None,username=None,password=None,application_name="connectedinsights",platform_url="https://platform.login.illumina.com"):
+    domain_credentials = dict()
+    domain_errors = dict()
+    workgroups = dict()
+    workgroup_errors = dict()
+    for entry in entries:
+        domain_url = entry['domain_url']
+        entry_api_key_file = entry.get('api_key_file') or api_key_file
+        domain_key = (domain_url,entry_api_key_file)
+        if domain_key not in domain_credentials.keys() and domain_key not in domain_errors.keys():
+            print(f"Grabbing user metadata for {domain_url}")
+            try:
+                domain_credentials[domain_key] = get_auth_credentials(domain_url,read_api_key_file(entry_api_key_file),username,password,application_name,platform_url)
+            except Exception as e:
+                domain_errors[domain_key] = f"{type(e).__name__}: {e}"
+                print(f"[Warning] Could not authenticate to {domain_url}: {domain_errors[domain_key]}")
+        if domain_key in domain_errors.keys():
+            entry['error'] = domain_errors[domain_key]
+            continue
+        auth_credentials = dict(domain_credentials[domain_key])
+        try:
+            workgroup_id = resolve_workgroup_id(domain_url,auth_credentials,entry.get('workgroup_id') or None,entry.get('workgroup_name') or None)
+        except Exception as e:
+            entry['error'] = f"{type(e).__name__}: {e}"
+            print(f"[Warning] Could not resolve the workgroup of {entry['metadata_csv']}: {entry['error']}")
+            continue
+        workgroup_key = (domain_url,entry_api_key_file,workgroup_id)
+        if workgroup_key not in workgroups.keys() and workgroup_key not in workgroup_errors.keys():
+            auth_credentials['X-ILMN-Workgroup'] = workgroup_id
+            print(f"Fetching configured diseases and cases for workgroup {workgroup_id} in {domain_url}")
+            try:
+                workgroups[workgroup_key] = {
+                    "auth_credentials": auth_credentials,
+                    "configured_snowmedct_ids": list(get_diseases_configured(domain_url,auth_credentials).keys()),
+                    "cases_present_in_ici": list(get_cases_present(domain_url,auth_credentials).keys())
+                }
+            except Exception as e:
+                workgroup_errors[workgroup_key] = f"{type(e).__name__}: {e}"
+                print(f"[Warning] Could not fetch the configuration of workgroup {workgroup_id} in {domain_url}: {workgroup_errors[workgroup_key]}")
+        if workgroup_key in workgroup_errors.keys():
+            entry['workgroup_id'] = workgroup_id
+            entry['error'] = workgroup_errors[workgroup_key]
+            continue
+        entry['workgroup_key'] = workgroup_key
+    return workgroups
+
+### Validation reports are written per manifest file: <metadata_csv>.validation<validation_report_extension>
+def upload_manifest_entry(entry,workgroup,lenient_mode=False,poll_interval=5,validation_report_extension=".json",validation_sample_limit=20):
+    domain_url = entry['domain_url']
+    metadata_csv = entry['metadata_csv']
+    upload_status = {"metadata_csv": metadata_csv, "domain_url": domain_url, "workgroup_id": workgroup['auth_credentials']['X-ILMN-Workgroup'], "file_id": None, "status": None, "error": None}
+    try:
+        validate_metadata_csv(domain_url,workgroup['auth_credentials'],metadata_csv,lenient_mode,configured_snowmedct_ids=workgroup['configured_snowmedct_ids'],cases_present_in_ici=workgroup['cases_present_in_ici'],validation_report_file=f"{metadata_csv}.validation{validation_report_extension}",validation_sample_limit=validation_sample_limit)
+        print(f"Uploading Case Metadata {metadata_csv} to Connected Insights")
+        upload_status['file_id'] = upload_case_metadata(domain_url,workgroup['auth_credentials'],metadata_csv)
+        ingestion_metadata = wait_for_ingestion(domain_url,workgroup['auth_credentials'],upload_status['file_id'],poll_interval)
+        upload_status['status'] = ingestion_metadata['status']
+    ### a failing file (e.g. a CSV without a Tumor_Type column) is recorded in the status report and does not stop the others
+    except Exception as e:
+        upload_status['status'] = "ERROR"
+        upload_status['error'] = f"{type(e).__name__}: {e}"
+    return upload_status
+
+def write_status_report(status_report,upload_statuses):
+    with open(status_report, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=["metadata_csv","domain_url","workgroup_id","file_id","status","error"])
+        writer.writeheader()
+        writer.writerows(upload_statuses)
+    return status_report
+
+def run_manifest_upload(manifest,status_report,api_key_file=None,username=None,password=None,application_name="connectedinsights",platform_url="https://platform.login.illumina.com",lenient_mode=False,max_workers=4,validation_report_extension=".json",validation_sample_limit=20):
+    entries = read_manifest(manifest)
+    workgroups = resolve_manifest_workgroups(entries,api_key_file,username,password,application_name,platform_url)
+    print(f"Validating and uploading {len(entries)} Case Metadata file(s) across {len(workgroups)} workgroup(s)")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = []
+        for entry in entries:
+            if 'workgroup_key' in entry.keys():
+                futures.append(pool.submit(upload_manifest_entry,entry,workgroups[entry['workgroup_key']],lenient_mode,5,validation_report_extension,validation_sample_limit))
+            else:
+                futures.append(None)
+        upload_statuses = []
+        for entry,future in zip(entries,futures):
+            if future is None:
+                upload_statuses.append({"metadata_csv": entry['metadata_csv'], "domain_url": entry['domain_url'], "workgroup_id": entry.get('workgroup_id') or None, "file_id": None, "status": "ERROR", "error": entry['error']})
+            else:
+                upload_statuses.append(future.result())
+    write_status_report(status_report,upload_statuses)
+    status_counts = dict()
+    for upload_status in upload_statuses:
+        status_counts[upload_status['status']] = status_counts.get(upload_status['status'], 0) + 1
+    status_counts_str = ", ".join([f"{status}: {count}" for status,count in status_counts.items()])
+    print(f"Upload status of {len(upload_statuses)} file(s): {status_counts_str}. See {status_report}")
+    return upload_statuses
+
 #################################
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--domain_url', default=None,required=True, type=str, help="Connected Insights domain URL")
+    parser.add_argument('--domain_url', default=None, type=str, help="Connected Insights domain URL")
     parser.add_argument('--api_key_file', default=None, type=str, help="path to API key file")
     parser.add_argument('--username', default=None, type=str, help="username [email] used to log into Connected Insights")
     parser.add_argument('--password', default=None, type=str, help="password used to log into Connected Insights")
-    parser.add_argument('--metadata_csv', default=None,required=True, type=str, help="output CSV containing case metadata for Connected Insights")
+    parser.add_argument('--metadata_csv', default=None, type=str, help="output CSV containing case metadata for Connected Insights. Parquet/Arrow files from the metadata generation script are accepted as well")
+    parser.add_argument('--manifest', default=None, type=str, help="CSV with the columns metadata_csv,domain_url and optionally workgroup_id,workgroup_name,api_key_file to upload several files in one run")
+    parser.add_argument('--max_workers', default=4, type=int, help="number of manifest files validated and uploaded concurrently")
+    parser.add_argument('--status_report', default=None, type=str, help="[OPTIONAL] CSV with the upload status of every manifest file")
     parser.add_argument('--workgroup_id', default=None, type=str, help="[OPTIONAL] Connected Insights Workgroup ID")
     parser.add_argument('--workgroup_name', default=None, type=str, help="[OPTIONAL] Connected Insights Workgroup Name to grab Workgroup ID")
     parser.add_argument('--application_name', default="connectedinsights", type=str, help="Connected Insights app name alias. Most usecases will not need this to be configured.")
     parser.add_argument('--platform_url', default="https://platform.login.illumina.com", type=str, help="Illumina Platform authentication.Most usecases will not need this to be configured.")
     parser.add_argument('--lenient_mode',  action="store_true", help="lenient mode crafting CSV for debugging")
+    parser.add_argument('--validation_report', default=None, type=str, help="[OPTIONAL] validation report file (.json or .csv). Default: <metadata_csv>.validation.json. In batch mode every manifest file gets <metadata_csv>.validation.json, or .csv when this option ends in .csv")
+    parser.add_argument('--validation_sample_limit', default=20, type=int, help="number of offending rows kept per field and reason in the validation report")
+    parser.add_argument('--delta_mode',  action="store_true", help="only upload cases that are new or changed compared to Connected Insights and previous uploads")
+    parser.add_argument('--fingerprint_store', default="case_metadata_fingerprints.json", type=str, help="file storing fingerprints of previously uploaded cases (delta mode)")
+    parser.add_argument('--run_id', default=None, type=str, help="[OPTIONAL] identifier of this run in the run journal")
+    parser.add_argument('--resume', default=None, type=str, help="run ID of an interrupted run to resume")
+    parser.add_argument('--journal_dir', default=".ci_metadata_runs", type=str, help="directory holding the run journals")
+    parser.add_argument('--rate_limit', nargs='+', default=[], type=str, help="[OPTIONAL] per host rate limits as host=requests_per_second[:burst]")
     args, extras = parser.parse_known_args()
+    ### a resumed run gets the arguments it was started with, so the journal is opened before they are checked
+    journal = None
+    if args.manifest is None:
+        if args.resume is None and (args.domain_url is None or args.metadata_csv is None):
+            raise ValueError("Please provide either --domain_url and --metadata_csv or a --manifest")
+        journal = run_journal.open_run_journal(args.journal_dir,args,run_id=args.resume or args.run_id,resume=args.resume is not None,parser=parser)
+    http_session.set_host_rate_limits(rate_limiter.parse_rate_limits(args.rate_limit))
+
+    # Batch mode: one run for every file of the manifest
+    if args.manifest is not None:
+        if args.delta_mode is True or args.resume is not None:
+            raise ValueError("--delta_mode and --resume are not supported together with --manifest")
+        status_report = args.status_report
+        if status_report is None:
+            timestampStr = dt.now().strftime("%Y%b%d_%H_%M_%S_%f")
+            status_report = f"upload_status_report.{timestampStr}.csv"
+        ### one validation report per manifest file; --validation_report only picks its format
+        validation_report_extension = ".json"
+        if args.validation_report is not None and os.path.splitext(args.validation_report)[1].lower() == ".csv":
+            validation_report_extension = ".csv"
+        run_manifest_upload(args.manifest,status_report,args.api_key_file,args.username,args.password,args.application_name,args.platform_url,args.lenient_mode,args.max_workers,validation_report_extension,args.validation_sample_limit)
+        http_session.report()
+        return
     #############
     username = args.username
     password = args.password
@@ -266,75 +616,80 @@ def main():
     domain_url = args.domain_url
     application_name = args.application_name
     platform_url = args.platform_url
-    API_KEY = None
     ############
-    if args.api_key_file is not None:
-        if os.path.isfile(args.api_key_file) is True:
-            with open(args.api_key_file, 'r') as f:
-                API_KEY = str(f.read().strip("\n"))
-
-    ## base64 encode username password combination
-    encoded_key = base64.b64encode(bytes(f"{username}:{password}", "utf-8")).decode()
-    auth_credentials = dict()
+    API_KEY = read_api_key_file(args.api_key_file)
 
     # STEP 1: Generate psToken from username and password
     print(f"Grabbing user metadata for {domain_url}")
-    if API_KEY is None:
-        ps_token = generate_ps_token(platform_url,application_name,domain_url,encoded_key)
-        auth_credentials['Authorization'] = f"{ps_token}"
-    else:
-        auth_credentials['Authorization'] = f"ApiKey {API_KEY}"
-    
-    auth_credentials['User-Agent'] = "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Mobile Safari/537.36"
-
-    auth_credentials['X-ILMN-Domain'] = domain_url.strip("https://").split(".")[0]
+    auth_credentials = get_auth_credentials(domain_url,API_KEY,username,password,application_name,platform_url)
     
     # STEP 2: Obtain WorkgroupID
-    if args.workgroup_name is None and args.workgroup_id is None:
-        workgroup_id = get_workgroup_id(domain_url,auth_credentials)
-    elif args.workgroup_name is not None and args.workgroup_id is None :
-        workgroup_id = get_workgroup_id(domain_url,auth_credentials,args.workgroup_name)
-    elif args.workgroup_name is None and args.workgroup_id is not None:
-        workgroup_id = args.workgroup_id
-    elif args.workgroup_name is not None and workgroup_id is not None:
-        workgroup_id = get_workgroup_id(domain_url,auth_credentials,args.workgroup_name)
-    if workgroup_id is None:
-        raise ValueError(f"Could not find workgroup id in the domain {domain_url}")
+    if run_journal.step_completed(journal,"workgroup") is True:
+        workgroup_id = journal['steps']['workgroup']['workgroup_id']
+    else:
+        workgroup_id = resolve_workgroup_id(domain_url,auth_credentials,args.workgroup_id,args.workgroup_name)
+        run_journal.complete_step(journal,"workgroup",workgroup_id=workgroup_id)
     auth_credentials['X-ILMN-Workgroup'] = workgroup_id
-    
-    # Validation STEP 2A: Check on Tumor Type --- SNOWMEDCT IDs configured in Connected Insights 
-    print(f"Validating Tumor_Type in Case Metadata file {metadata_csv}")
-    configured_disease_terms = get_diseases_configured(domain_url,auth_credentials)
-    configured_snowmedct_ids = list(configured_disease_terms.keys())
-    invalid_tumor_type_configurations = validate_tumor_types_in_csv(configured_snowmedct_ids,metadata_csv)
-    if len(list(invalid_tumor_type_configurations.keys())) > 0:
-        for idx,validation_warning in enumerate(invalid_tumor_type_configurations):
-            print(invalid_tumor_type_configurations[validation_warning])
-    if args.lenient_mode is False:
-        raise ValueError(f"Invalid Tumor Type(s) supplied to {metadata_csv}")
-    
-    print(f"Validating Case_IDs in Case Metadata file {metadata_csv}")
-    # Validation STEP 2B: Check if cases in CSV intersect with Case_IDs present in in Connected Insights 
-    cases_present_in_ici_metadata = get_cases_present(domain_url,auth_credentials)
-    cases_present_in_ici = list(cases_present_in_ici_metadata.keys())
-    ##print(cases_present_in_ici)
-    case_id_warnings = validate_case_id_in_csv(cases_present_in_ici,metadata_csv)
-    if len(list(case_id_warnings.keys())) > 0:
-        for idx,validation_warning in enumerate(case_id_warnings):
-            print(case_id_warnings[validation_warning])
-    if args.lenient_mode is False:
-        raise ValueError(f"Case ID already found in Connected Insights.\nEither modify {metadata_csv} with unique case identifiers or delete case and re-ingest metadata")
 
+    # Resume: the file was already uploaded, only the ingestion status is left to check
+    file_id = None
+    cases_to_upload = None
+    if run_journal.step_completed(journal,"upload") is True:
+        file_id = journal['steps']['upload']['file_id']
+        metadata_csv = journal['steps']['upload']['metadata_csv']
+        cases_to_upload = journal['steps']['upload']['cases_to_upload']
+        print(f"[Resume] {metadata_csv} was already uploaded as file {file_id}")
+        if args.delta_mode is True:
+            fingerprints = load_fingerprint_store(args.fingerprint_store)
+            workgroup_fingerprints = fingerprints.setdefault(workgroup_id, dict())
+            headers,rows = metadata_table.read_metadata_table(metadata_csv)
+            case_rows_by_id = group_rows_by_case(rows)
+
+    # Delta mode: diff the CSV against Connected Insights and the fingerprint store, upload only new/changed cases
+    if args.delta_mode is True and file_id is None:
+        print(f"Comparing Case Metadata file {metadata_csv} with cases in Connected Insights")
+        cases_present_in_ici_metadata = get_cases_present(domain_url,auth_credentials,include_metadata=True)
+        fingerprints = load_fingerprint_store(args.fingerprint_store)
+        workgroup_fingerprints = fingerprints.setdefault(workgroup_id, dict())
+        headers,rows = metadata_table.read_metadata_table(metadata_csv)
+        case_rows_by_id = group_rows_by_case(rows)
+        delta_plan = plan_delta_upload(case_rows_by_id,cases_present_in_ici_metadata,workgroup_fingerprints)
+        print(f"[Delta] {len(delta_plan['new'])} new, {len(delta_plan['changed'])} changed, {len(delta_plan['unchanged'])} unchanged case(s) skipped")
+        cases_to_upload = delta_plan["new"] + delta_plan["changed"]
+        if len(cases_to_upload) == 0:
+            save_fingerprint_store(args.fingerprint_store,fingerprints)
+            print(f"[Delta] Nothing to upload from {metadata_csv}")
+            http_session.report()
+            return
+        metadata_csv = write_delta_csv(f"{os.path.splitext(metadata_csv)[0]}.delta.csv",headers,case_rows_by_id,cases_to_upload)
+        print(f"[Delta] Uploading {len(cases_to_upload)} case(s) from {metadata_csv}")
+    
+    # Validation STEP 2A + 2B: Check on Tumor Type and Case_IDs against Connected Insights
+    if file_id is not None or run_journal.step_completed(journal,"validation") is True:
+        print(f"[Resume] Skipping validation of {metadata_csv}")
+    else:
+        validate_metadata_csv(domain_url,auth_credentials,metadata_csv,args.lenient_mode,args.delta_mode,validation_report_file=args.validation_report,validation_sample_limit=args.validation_sample_limit)
+        run_journal.complete_step(journal,"validation",files=[metadata_csv])
 
     # STEP 3: Upload Case Metadata into Connected Insights
-    print(f"Uploading Case Metadata {metadata_csv} to Connected Insights")
-    file_id = upload_case_metadata(domain_url,auth_credentials,metadata_csv)
+    if file_id is None:
+        print(f"Uploading Case Metadata {metadata_csv} to Connected Insights")
+        file_id = upload_case_metadata(domain_url,auth_credentials,metadata_csv)
+        run_journal.complete_step(journal,"upload",files=[metadata_csv],file_id=file_id,metadata_csv=metadata_csv,cases_to_upload=cases_to_upload)
 
     # STEP 4: Check on ingestion status and report back
-    ingestion_status = "QUEUED"
-    while ingestion_status in ["QUEUED","IN_PROGRESS"]:
-        ingestion_metadata = case_metadata_ingestion_check(domain_url,auth_credentials,file_id)
-        ingestion_status = ingestion_metadata['status']
+    ingestion_metadata = wait_for_ingestion(domain_url,auth_credentials,file_id)
+    run_journal.complete_step(journal,"ingestion",status=ingestion_metadata['status'])
+
+    # Delta mode: remember what was uploaded so the next run can skip it
+    if args.delta_mode is True:
+        if "FAIL" in str(ingestion_metadata['status']).upper():
+            print(f"[Delta] Ingestion finished with status {ingestion_metadata['status']}; fingerprints not updated")
+        else:
+            for case_id in cases_to_upload:
+                workgroup_fingerprints[case_id] = case_fingerprint(case_rows_by_id[case_id])
+            save_fingerprint_store(args.fingerprint_store,fingerprints)
+    http_session.report()
 
     ### TODO
     # How to deal with users with multiple workgroups?
@@ -0,0 +1,114 @@
+# Reading and writing case metadata tables: CSV (RFC 4180 quoting) and, with pyarrow installed, Parquet/Arrow
+import os
+import csv
+
+columnar_extensions = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ValueError("Parquet/Arrow metadata files need pyarrow. Install it with: pip3 install pyarrow")
+    return pyarrow
+
+def get_output_file(output_csv,output_format):
+    if output_format == "csv":
+        return output_csv
+    return f"{os.path.splitext(output_csv)[0]}.{output_format}"
+
+### Streams rows to every requested format as they are produced, so no output is held in memory as a whole.
+### Columnar formats are written in record batches of batch_size rows; every column is a string column
+class MetadataTableWriter:
+    def __init__(self,output_csv,headers,output_formats=["csv"],batch_size=65536):
+        self.headers = list(headers)
+        self.batch_size = batch_size
+        self.batch = []
+        self.output_files = []
+        self.csv_file = None
+        self.csv_writer = None
+        self.columnar_writers = []
+        for output_format in output_formats:
+            output_file = get_output_file(output_csv,output_format)
+            self.output_files.append(output_file)
+            if output_format == "csv":
+                self.csv_file = open(output_file, "w", newline="")
+                self.csv_writer = csv.writer(self.csv_file)
+                self.csv_writer.writerow(self.headers)
+            elif output_format in ["parquet","arrow"]:
+                pyarrow = import_pyarrow()
+                self.schema = pyarrow.schema([(header, pyarrow.string()) for header in self.headers])
+                if output_format == "parquet":
+                    self.columnar_writers.append(pyarrow.parquet.ParquetWriter(output_file, self.schema))
+                else:
+                    self.columnar_writers.append(pyarrow.ipc.new_file(output_file, self.schema))
+            else:
+                raise ValueError(f"Unknown output format {output_format}. Expected one of: csv, parquet, arrow")
+
+    def writerow(self,row):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(row)
+        if len(self.columnar_writers) > 0:
+            self.batch.append(row)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def writerows(self,rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        pyarrow = import_pyarrow()
+        columns = [pyarrow.array([row[idx] for row in self.batch], type=pyarrow.string()) for idx in range(len(self.headers))]
+        record_batch = pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+        for columnar_writer in self.columnar_writers:
+            columnar_writer.write_batch(record_batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        for columnar_writer in self.columnar_writers:
+            columnar_writer.close()
+        if self.csv_file is not None:
+            self.csv_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+def write_metadata_csv(output_csv,headers,rows):
+    with MetadataTableWriter(output_csv,headers) as writer:
+        writer.writerows(rows)
+    return output_csv
+
+### (headers, list of row dicts) from a CSV, Parquet or Arrow metadata file
+def read_metadata_table(metadata_file):
+    output_format = columnar_extensions.get(os.path.splitext(metadata_file)[1].lower(), "csv")
+    if output_format == "csv":
+        with open(metadata_file, "r", newline="") as open_file:
+            reader = csv.DictReader(open_file, restval="")
+            rows = [row for row in reader]
+            headers = reader.fieldnames
+        return headers,rows
+    pyarrow = import_pyarrow()
+    if output_format == "parquet":
+        table = pyarrow.parquet.read_table(metadata_file)
+    else:
+        with pyarrow.memory_map(metadata_file, "r") as source:
+            table = pyarrow.ipc.open_file(source).read_all()
+    rows = [{k: ("" if v is None else str(v)) for k,v in row.items()} for row in table.to_pylist()]
+    return table.column_names,rows
+
+### Connected Insights only ingests CSV: columnar files are converted next to the original before upload
+def metadata_csv_for_upload(metadata_file):
+    if os.path.splitext(metadata_file)[1].lower() not in columnar_extensions.keys():
+        return metadata_file
+    headers,rows = read_metadata_table(metadata_file)
+    metadata_csv = f"{os.path.splitext(metadata_file)[0]}.csv"
+    write_metadata_csv(metadata_csv,headers,[[row[header] for header in headers] for row in rows])
+    return metadata_csv
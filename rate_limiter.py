@@ -0,0 +1,151 @@
+# Client-side rate limiting shared by every outbound call (ICA, Connected Insights, Snowstorm)
+import time
+import threading
+from datetime import datetime as dt
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+
+### requests per second and burst size per host; anything not listed uses default_rate_limit
+default_rate_limit = (10.0, 10)
+default_host_rate_limits = dict()
+### Snowstorm throttles anonymous clients
+default_host_rate_limits["browser.ihtsdotools.org"] = (2.0, 2)
+
+### parse --rate_limit values of the form host=requests_per_second[:burst]
+def parse_rate_limits(rate_limit_args):
+    host_rate_limits = dict()
+    for rate_limit in rate_limit_args:
+        try:
+            host,limit = rate_limit.split("=")
+            if ":" in limit:
+                rate,burst = limit.split(":")
+            else:
+                rate,burst = limit,limit
+            rate = float(rate)
+            burst = max(1, int(float(burst)))
+        except ValueError:
+            raise ValueError(f"Could not parse the rate limit {rate_limit}. Expected host=requests_per_second[:burst]")
+        ### limits are matched against the host name of each request URL
+        if host == "" or "/" in host or ":" in host:
+            raise ValueError(f"Invalid host in the rate limit {rate_limit}. Give the host name only, e.g. ica.illumina.com=20")
+        if (rate > 0) is False:
+            raise ValueError(f"Invalid rate in the rate limit {rate_limit}. requests_per_second must be greater than 0")
+        host_rate_limits[host] = (rate, burst)
+    return host_rate_limits
+
+### seconds to wait from a Retry-After header: either a number of seconds or an HTTP date
+def parse_retry_after(retry_after):
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - dt.now(timezone.utc)).total_seconds())
+
+class TokenBucket:
+    ### the rate is halved on every 429 and grows back towards the configured rate on every success
+    def __init__(self,rate,burst):
+        self.configured_rate = rate
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    ### reserve a token and sleep until it is available; returns the seconds waited
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self,retry_after):
+        with self.lock:
+            self.rate = max(self.configured_rate / 16, self.rate / 2)
+            ### nobody gets a token before retry_after has passed, counted from now: the time the
+            ### throttled request was in flight must not count as refill
+            self.updated = time.monotonic()
+            self.tokens = min(self.tokens, -retry_after * self.rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.configured_rate, self.rate + self.configured_rate / 20)
+
+class RateLimitedSession(requests.Session):
+    def __init__(self,host_rate_limits=None,max_retries=5):
+        super().__init__()
+        self.host_rate_limits = dict(default_host_rate_limits)
+        if host_rate_limits is not None:
+            self.host_rate_limits.update(host_rate_limits)
+        self.max_retries = max_retries
+        self.buckets = dict()
+        self.stats = dict()
+        self.lock = threading.Lock()
+
+    def set_host_rate_limits(self,host_rate_limits):
+        with self.lock:
+            self.host_rate_limits.update(host_rate_limits)
+            for host in host_rate_limits.keys():
+                self.buckets.pop(host, None)
+
+    def get_bucket(self,host):
+        with self.lock:
+            if host not in self.buckets.keys():
+                rate,burst = self.host_rate_limits.get(host, default_rate_limit)
+                self.buckets[host] = TokenBucket(rate,burst)
+                self.stats[host] = {"requests": 0, "throttled": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+            return self.buckets[host]
+
+    def record(self,host,waited,throttled=False):
+        with self.lock:
+            host_stats = self.stats[host]
+            host_stats["requests"] = host_stats["requests"] + 1
+            host_stats["wait_seconds"] = host_stats["wait_seconds"] + waited
+            host_stats["max_wait_seconds"] = max(host_stats["max_wait_seconds"], waited)
+            if throttled is True:
+                host_stats["throttled"] = host_stats["throttled"] + 1
+
+    def request(self,method,url,*args,**kwargs):
+        host = urlparse(url).hostname
+        bucket = self.get_bucket(host)
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            response = super().request(method,url,*args,**kwargs)
+            if response.status_code != 429:
+                self.record(host,waited)
+                bucket.succeeded()
+                return response
+            self.record(host,waited,throttled=True)
+            if attempt >= self.max_retries:
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = 2 ** attempt
+            print(f"[Rate-Limit] {host} returned 429, retrying in {retry_after:.1f} seconds")
+            bucket.throttled(retry_after)
+            ### uploaded files have been read by the first attempt
+            for file_tuple in (kwargs.get("files") or {}).values():
+                if isinstance(file_tuple, tuple) and hasattr(file_tuple[1], "seek"):
+                    file_tuple[1].seek(0)
+            attempt = attempt + 1
+
+    def report(self):
+        with self.lock:
+            for host,host_stats in self.stats.items():
+                average_wait = host_stats["wait_seconds"] / max(1, host_stats["requests"])
+                print(f"[Rate-Limit] {host}: {host_stats['requests']} request(s), {host_stats['throttled']} throttled, queue wait {host_stats['wait_seconds']:.2f}s total / {average_wait:.3f}s average / {host_stats['max_wait_seconds']:.2f}s max")
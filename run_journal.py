@@ -0,0 +1,85 @@
+# Helper module to checkpoint generate/upload runs so they can be resumed with --resume <run_id>
+import os
+import json
+import hashlib
+from datetime import datetime as dt
+
+### arguments that are never written to the journal; they have to be given again on --resume
+secret_arguments = ["api_key","password","ci_password"]
+
+def file_checksum(file_path):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def get_run_directory(journal_dir,run_id):
+    return os.path.abspath(os.path.join(journal_dir, run_id))
+
+def save_run_journal(journal):
+    journal_file = os.path.join(journal['run_directory'], "journal.json")
+    tmp_file = f"{journal_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(journal, f, indent=4)
+    os.replace(tmp_file, journal_file)
+
+### start a new run, or load the journal of run_id when resuming.
+### On resume the arguments of the original run are restored onto args, except secrets, the journal options and
+### the arguments given on the command line (i.e. that differ from the parser defaults)
+def open_run_journal(journal_dir,args,run_id=None,resume=False,parser=None):
+    if resume is True:
+        run_directory = get_run_directory(journal_dir,run_id)
+        journal_file = os.path.join(run_directory, "journal.json")
+        if os.path.isfile(journal_file) is False:
+            raise ValueError(f"Could not find a journal for the run {run_id} in {journal_dir}")
+        with open(journal_file, 'r') as f:
+            journal = json.load(f)
+        arguments_given = []
+        for k,v in journal['args'].items():
+            if k in secret_arguments or k in ["resume","run_id","journal_dir"]:
+                continue
+            if parser is not None and hasattr(args, k) and getattr(args, k) != parser.get_default(k):
+                if getattr(args, k) != v:
+                    arguments_given.append(k)
+                continue
+            setattr(args, k, v)
+        if len(arguments_given) > 0:
+            arguments_given_str = ", ".join(arguments_given)
+            print(f"[Resume] Using {arguments_given_str} from the command line instead of the values saved for run {run_id}")
+        completed_steps_str = ", ".join(list(journal['steps'].keys()))
+        print(f"[Resume] Resuming run {run_id}. Completed steps: {completed_steps_str}")
+    else:
+        if run_id is None:
+            run_id = dt.now().strftime("%Y%b%d_%H_%M_%S_%f")
+        run_directory = get_run_directory(journal_dir,run_id)
+        os.makedirs(run_directory, exist_ok=True)
+        journal = dict()
+        journal['run_id'] = run_id
+        journal['created'] = dt.now().isoformat()
+        journal['args'] = {k: v for k,v in vars(args).items() if k not in secret_arguments}
+        journal['steps'] = dict()
+        print(f"Run ID {run_id}. Resume this run with --resume {run_id}")
+    journal['run_directory'] = run_directory
+    save_run_journal(journal)
+    return journal
+
+### a step only counts as completed if the files it produced are unchanged since it was recorded.
+### Without a journal (journal is None) nothing is recorded and no step is ever completed
+def step_completed(journal,step):
+    if journal is None or step not in journal['steps'].keys():
+        return False
+    for file_path,checksum in journal['steps'][step].get('checksums', {}).items():
+        if os.path.isfile(file_path) is False or file_checksum(file_path) != checksum:
+            print(f"[Resume] {file_path} changed since step {step} was completed, repeating the step")
+            return False
+    return True
+
+def complete_step(journal,step,files=[],**details):
+    if journal is None:
+        return None
+    journal['steps'][step] = dict(details)
+    journal['steps'][step]['completed'] = dt.now().isoformat()
+    journal['steps'][step]['checksums'] = {os.path.abspath(file_path): file_checksum(file_path) for file_path in files}
+    save_run_journal(journal)
+    return journal['steps'][step]
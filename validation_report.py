@@ -0,0 +1,72 @@
+# Structured validation results: issues are counted per field and reason in memory and written once,
+# instead of printing every offending line to the console
+import os
+import csv
+import json
+
+class ValidationReport:
+    def __init__(self,source,sample_limit=20):
+        self.source = source
+        self.sample_limit = sample_limit
+        self.rows_checked = 0
+        self.counts = dict()
+        self.samples = dict()
+        self.expected_values = dict()
+        self.lines_with_issues = set()
+
+    ### one issue for a field of a line; only the first sample_limit rows per (field, reason) are kept
+    def add(self,field,reason,line_number,value=None,row=None):
+        key = (field,reason)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.lines_with_issues.add(line_number)
+        samples = self.samples.setdefault(key, [])
+        if len(samples) < self.sample_limit:
+            samples.append({"line_number": line_number, "value": value, "row": row})
+
+    ### valid values of a field are recorded once for the whole report, not per offending line
+    def set_expected_values(self,field,expected_values):
+        self.expected_values[field] = list(expected_values)
+
+    def count(self,field=None,reason=None):
+        total = 0
+        for (k_field,k_reason),n in self.counts.items():
+            if (field is None or k_field == field) and (reason is None or k_reason == reason):
+                total = total + n
+        return total
+
+    def to_dict(self):
+        counts_by_field = dict()
+        counts_by_reason = dict()
+        for (field,reason),n in self.counts.items():
+            counts_by_field[field] = counts_by_field.get(field, 0) + n
+            counts_by_reason[reason] = counts_by_reason.get(reason, 0) + n
+        return {
+            "source": self.source,
+            "rows_checked": self.rows_checked,
+            "lines_with_issues": len(self.lines_with_issues),
+            "counts_by_field": counts_by_field,
+            "counts_by_reason": counts_by_reason,
+            "issues": [{"field": field, "reason": reason, "count": n, "samples": self.samples[(field,reason)]} for (field,reason),n in self.counts.items()],
+            "expected_values": self.expected_values
+        }
+
+    ### JSON with everything, or CSV with one line per sampled issue
+    def write(self,report_file):
+        if os.path.splitext(report_file)[1].lower() == ".csv":
+            with open(report_file, "w", newline="") as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(["field","reason","count","line_number","value","row"])
+                for (field,reason),n in self.counts.items():
+                    for sample in self.samples[(field,reason)]:
+                        writer.writerow([field,reason,n,sample['line_number'],sample['value'],json.dumps(sample['row'])])
+        else:
+            with open(report_file, "w") as outfile:
+                json.dump(self.to_dict(), outfile, indent=4)
+        return report_file
+
+    def print_summary(self,report_file=None):
+        print(f"[Validation] {self.source}: {self.rows_checked} row(s) checked, {len(self.lines_with_issues)} with issues")
+        for (field,reason),n in sorted(self.counts.items()):
+            print(f"[Validation]   {field}: {reason} x{n}")
+        if report_file is not None:
+            print(f"[Validation] Details and sample rows in {report_file}")